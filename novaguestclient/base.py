@@ -18,11 +18,14 @@
 #    under the License.
 
 import copy
+import logging
 
 import six
 
 from oslo_utils import strutils
 
+LOG = logging.getLogger(__name__)
+
 
 def getid(obj):
     """Return id if argument is a Resource.
@@ -136,6 +139,8 @@ class BaseManager(object):
     etc.) and provide CRUD operations for them.
     """
     resource_class = None
+    # Kind of the resources added to the client's completion cache, if any
+    completion_kind = None
 
     def __init__(self, client):
         """Initializes BaseManager with `client`.
@@ -145,7 +150,7 @@ class BaseManager(object):
         self.client = client
 
     def _list(self, url, response_key=None, obj_class=None, json=None,
-              values_key='values'):
+              values_key='values', timeout=None):
         """List the collection.
         :param url: a partial URL, e.g., '/servers'
         :param response_key: the key to be looked up in response dictionary,
@@ -155,11 +160,13 @@ class BaseManager(object):
             (self.resource_class will be used by default)
         :param json: data that will be encoded as JSON and passed in POST
             request (GET will be sent by default)
+        :param timeout: seconds after which the call fails with
+            DeadlineExceeded
         """
         if json:
-            body = self.client.post(url, json=json).json()
+            body = self.client.post(url, json=json, timeout=timeout).json()
         else:
-            body = self.client.get(url).json()
+            body = self.client.get(url, timeout=timeout).json()
 
         if obj_class is None:
             obj_class = self.resource_class
@@ -172,18 +179,36 @@ class BaseManager(object):
         except (KeyError, TypeError):
             pass
 
-        return [obj_class(self, res, loaded=True) for res in data if res]
+        items = [obj_class(self, res, loaded=True) for res in data if res]
+        self.write_to_completion_cache(items)
+        return items
 
-    def _get(self, url, response_key=None):
+    def _get(self, url, response_key=None, timeout=None):
         """Get an object from collection.
         :param url: a partial URL, e.g., '/servers'
         :param response_key: the key to be looked up in response dictionary,
             e.g., 'server'. If response_key is None - all response body
             will be used.
+        :param timeout: seconds after which the call fails with
+            DeadlineExceeded
         """
-        body = self.client.get(url).json()
+        body = self.client.get(url, timeout=timeout).json()
         data = body[response_key] if response_key is not None else body
-        return self.resource_class(self, data, loaded=True)
+        item = self.resource_class(self, data, loaded=True)
+        self.write_to_completion_cache([item])
+        return item
+
+    def write_to_completion_cache(self, items):
+        """ Adds the IDs and human IDs of the given resources to the
+        client's completion cache, if any. """
+        cache = getattr(self.client, 'completion_cache', None)
+        if cache is None or self.completion_kind is None:
+            return
+        try:
+            cache.add_resources(self.completion_kind, items)
+        except (IOError, OSError, ValueError) as ex:
+            # NOTE: completion is best effort and must not fail the call
+            LOG.debug("Could not update the completion cache: %s", ex)
 
     def _post(self, url, json, response_key=None, return_raw=False):
         """Create an object.
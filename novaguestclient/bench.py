@@ -0,0 +1,265 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Load generation against a guest-agent deployment, along with a local
+stand-in server mimicking the guest-agent API.
+"""
+
+import array
+import collections
+import json
+import re
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from novaguestclient import constants
+from novaguestclient import profiling
+from novaguestclient import tracing
+
+_PERCENTILES = (50, 90, 95, 99)
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    index = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class BenchResult(object):
+    def __init__(self, latencies, errors, elapsed, requested_rate=None,
+                 achieved_rate=None):
+        """
+        :param latencies: latencies in seconds of the successful calls
+        :param errors: mapping of exception type names to their counts
+        :param elapsed: total duration of the run in seconds
+        :param requested_rate: calls per second which should have been
+            started, if the run had a fixed rate
+        :param achieved_rate: calls per second actually started
+        """
+        self.latencies = latencies
+        self.errors = errors
+        self.elapsed = elapsed
+        self.requested_rate = requested_rate
+        self.achieved_rate = achieved_rate
+
+    def to_dict(self):
+        successes = len(self.latencies)
+        failures = sum(self.errors.values())
+        total = successes + failures
+        latencies = sorted(self.latencies)
+        latency = dict(
+            ('p%d' % p, get_percentile(latencies, p)) for p in _PERCENTILES)
+        latency['min'] = latencies[0] if latencies else None
+        latency['max'] = latencies[-1] if latencies else None
+        latency['mean'] = sum(latencies) / successes if successes else None
+        return {
+            'requests': total,
+            'successes': successes,
+            'errors': failures,
+            'elapsed': self.elapsed,
+            'throughput': total / self.elapsed if self.elapsed else 0.0,
+            'requested_rate': self.requested_rate,
+            'achieved_rate': self.achieved_rate,
+            'latency': latency,
+            'errors_by_type': dict(self.errors),
+        }
+
+
+class LoadGenerator(object):
+    """ Calls `fn` from `concurrency` threads until either `duration`
+    seconds passed or `requests` calls were made.
+
+    :param rate: if set, calls are started at this fixed overall rate per
+        second instead of as fast as the threads allow. Latencies are then
+        measured from the time at which each call was scheduled, so that
+        calls delayed by busy threads count their wait, rather than being
+        left out of the measurements.
+    """
+
+    def __init__(self, fn, concurrency=1, rate=None, duration=None,
+                 requests=None):
+        if duration is None and requests is None:
+            raise ValueError("Either a duration or a number of requests "
+                             "must be provided")
+        self._fn = fn
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+
+        self._lock = threading.Lock()
+        self._started = 0
+        self._start_time = None
+        self._first_call_time = None
+        self._last_call_time = None
+        self._latencies = array.array('d')
+        self._errors = collections.Counter()
+
+    def _next_slot(self):
+        """ Returns the time at which the next call should start, or None
+        if the run is over. """
+        with self._lock:
+            if self.requests is not None and self._started >= self.requests:
+                return None
+            if self.rate:
+                slot = self._start_time + self._started / float(self.rate)
+            else:
+                slot = time.time()
+            if (self.duration is not None and
+                    slot >= self._start_time + self.duration):
+                return None
+            self._started += 1
+            return slot
+
+    def _worker(self):
+        while True:
+            slot = self._next_slot()
+            if slot is None:
+                return
+            delay = slot - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            now = time.time()
+            with self._lock:
+                if self._first_call_time is None:
+                    self._first_call_time = now
+                self._last_call_time = max(self._last_call_time or now, now)
+            start = slot if self.rate else now
+            try:
+                self._fn()
+            except Exception as ex:
+                with self._lock:
+                    self._errors[type(ex).__name__] += 1
+            else:
+                latency = time.time() - start
+                with self._lock:
+                    self._latencies.append(latency)
+
+    def _get_achieved_rate(self):
+        if self._started < 2 or (
+                self._last_call_time <= self._first_call_time):
+            return None
+        return (self._started - 1) / (
+            self._last_call_time - self._first_call_time)
+
+    def run(self):
+        self._start_time = time.time()
+        worker_fn = profiling.wrap(tracing.wrap(self._worker))
+        workers = [threading.Thread(target=worker_fn)
+                   for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return BenchResult(
+            self._latencies, self._errors, time.time() - self._start_time,
+            requested_rate=self.rate,
+            achieved_rate=self._get_achieved_rate())
+
+
+class _StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # NOTE: headers and body are written separately, which would otherwise
+    # stall each response on delayed ACKs
+    disable_nagle_algorithm = True
+
+    _ACTIONS_PATH = re.compile(r'^/[^/]+/networking/([^/]+)/actions$')
+    _BATCH_ACTIONS_PATH = re.compile(r'^/[^/]+/networking/actions$')
+    _VERSION_PATH = re.compile(r'^/([^/]+)/?$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        match = self._VERSION_PATH.match(self.path)
+        if match:
+            self._send_json(200, {'version': {
+                'id': match.group(1),
+                'capabilities': list(self.server.capabilities)}})
+            return
+        self._send_json(200, {})
+
+    def _apply_networking(self, instance_id):
+        return {'success': True,
+                'message': 'Networking applied on %s' % instance_id}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        time.sleep(self.server.latency)
+
+        if 'apply-networking' not in body:
+            self._send_json(400, {'error': 'Unknown action'})
+            return
+
+        match = self._ACTIONS_PATH.match(self.path)
+        if match:
+            self._send_json(200, {
+                'apply-networking': self._apply_networking(match.group(1))})
+        elif (self._BATCH_ACTIONS_PATH.match(self.path) and
+                constants.API_CAPABILITY_BATCH_ACTIONS in
+                self.server.capabilities):
+            instance_ids = body['apply-networking']['instance_ids']
+            self._send_json(200, {'apply-networking': dict(
+                (instance_id, self._apply_networking(instance_id))
+                for instance_id in instance_ids)})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local HTTP server answering like a healthy guest agent.
+
+    :param latency: seconds to wait before answering each request
+    :param capabilities: optional API features advertised by the version
+        document, e.g. constants.API_CAPABILITY_BATCH_ACTIONS
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 capabilities=()):
+        self.latency = latency
+        self.capabilities = frozenset(capabilities)
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (host, port), _StandInRequestHandler)
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
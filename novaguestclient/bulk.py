@@ -0,0 +1,499 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Concurrent execution of per-instance operations and memory-bounded
+aggregation of their outcomes.
+"""
+
+import array
+import collections
+import math
+import threading
+import time
+
+from novaguestclient import profiling
+from novaguestclient import tracing
+
+OUTCOME_NOT_RUN = 0
+OUTCOME_SUCCESS = 1
+OUTCOME_FAILURE = 2
+OUTCOME_ERROR = 3
+OUTCOME_SKIPPED = 4
+
+OUTCOME_NAMES = {
+    OUTCOME_NOT_RUN: 'not_run',
+    OUTCOME_SUCCESS: 'success',
+    OUTCOME_FAILURE: 'failure',
+    OUTCOME_ERROR: 'error',
+    OUTCOME_SKIPPED: 'skipped',
+}
+
+_NO_MESSAGE = 0
+_OTHER_MESSAGES = 1
+
+
+ORDER_FIFO = 'fifo'
+ORDER_SHORTEST_FIRST = 'shortest-first'
+ORDER_LONGEST_FIRST = 'longest-first'
+
+ORDERS = (ORDER_FIFO, ORDER_SHORTEST_FIRST, ORDER_LONGEST_FIRST)
+
+# Weight of the latest call in the running estimate of a group's duration
+_DURATION_SMOOTHING = 0.2
+# Items are read past the lookahead while all the queued ones belong to
+# groups at their concurrency limit, up to this many times the lookahead
+_MAX_LOOKAHEAD_FACTOR = 10
+
+
+class _GroupState(object):
+    def __init__(self, limit, expected_duration):
+        self.queue = collections.deque()
+        self.limit = limit
+        self.running = 0
+        self.expected_duration = expected_duration
+        self.calls = 0
+        self.errors = 0
+        self.skipped = 0
+        self.busy_time = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def to_dict(self):
+        elapsed = None
+        if self.first_start is not None and self.last_end is not None:
+            elapsed = self.last_end - self.first_start
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'concurrency': self.limit,
+            'mean_duration': (self.busy_time / self.calls
+                              if self.calls else None),
+            'elapsed': elapsed,
+            'throughput': (self.calls / elapsed if elapsed else None),
+        }
+
+
+class _Scheduler(object):
+    """ Hands out items to the worker threads, keeping a bounded number of
+    items read ahead in one queue per group and honoring the per-group
+    concurrency limits. """
+
+    def __init__(self, items, concurrency, group_key, group_concurrency,
+                 order, expected_durations, lookahead, item_size=None):
+        if order not in ORDERS:
+            raise ValueError("Invalid order '%s', expected one of: %s" % (
+                order, ', '.join(ORDERS)))
+        if concurrency < 1:
+            raise ValueError("The concurrency must be at least 1")
+        for group, limit in (group_concurrency or {}).items():
+            if limit < 1:
+                raise ValueError(
+                    "The concurrency of group '%s' must be at least 1" % group)
+        self._items = enumerate(items)
+        self._exhausted = False
+        self._buffered = 0
+        self._concurrency = concurrency
+        self._group_key = group_key
+        self._item_size = item_size
+        self._group_concurrency = group_concurrency or {}
+        self._order = order
+        self._expected_durations = expected_durations or {}
+        self._lookahead = lookahead
+        self._max_buffered = lookahead * _MAX_LOOKAHEAD_FACTOR
+        self._groups = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._errors = []
+
+    def _get_group(self, group):
+        state = self._groups.get(group)
+        if state is None:
+            limit = self._group_concurrency.get(group, self._concurrency)
+            state = _GroupState(limit, self._expected_durations.get(group))
+            self._groups[group] = state
+        return state
+
+    def _get_size(self, item):
+        return self._item_size(item) if self._item_size else 1
+
+    def _read(self):
+        try:
+            index, item = next(self._items)
+        except StopIteration:
+            self._exhausted = True
+            return
+        group = self._group_key(item) if self._group_key else None
+        self._get_group(group).queue.append((index, item))
+        self._buffered += self._get_size(item)
+
+    def _fill(self):
+        while not self._exhausted and self._buffered < self._lookahead:
+            self._read()
+
+    def _pick_group(self):
+        eligible = [(group, state) for (group, state) in self._groups.items()
+                    if state.queue and state.running < state.limit]
+        if not eligible:
+            return None
+        if self._order == ORDER_FIFO:
+            return min(eligible, key=lambda gs: gs[1].queue[0][0])
+        # NOTE: groups without an estimate yet come first, to get one
+        sign = 1 if self._order == ORDER_SHORTEST_FIRST else -1
+        return min(eligible, key=lambda gs: (
+            gs[1].expected_duration is not None,
+            sign * (gs[1].expected_duration or 0)))
+
+    def next(self):
+        """ Returns the next (group, index, item) to run, or None once all
+        the items were handed out. """
+        with self._cond:
+            while True:
+                if self._errors:
+                    return None
+                self._fill()
+                picked = self._pick_group()
+                # NOTE: a full lookahead of items of groups at their limit
+                # must not hold back the other groups
+                while (picked is None and not self._exhausted and
+                       self._buffered < self._max_buffered):
+                    self._read()
+                    picked = self._pick_group()
+                if picked is not None:
+                    group, state = picked
+                    index, item = state.queue.popleft()
+                    self._buffered -= self._get_size(item)
+                    state.running += 1
+                    if state.first_start is None:
+                        state.first_start = time.time()
+                    return group, index, item
+                if self._exhausted and not self._buffered:
+                    return None
+                self._cond.wait()
+
+    def done(self, group, duration, failed):
+        with self._cond:
+            state = self._groups[group]
+            state.running -= 1
+            state.calls += 1
+            state.errors += int(failed)
+            state.busy_time += duration
+            state.last_end = time.time()
+            if state.expected_duration is None:
+                state.expected_duration = duration
+            else:
+                state.expected_duration += _DURATION_SMOOTHING * (
+                    duration - state.expected_duration)
+            self._cond.notify_all()
+
+    def fail(self, exc):
+        """ Stops handing out items after an unexpected error of a worker,
+        re-raised once all the workers stopped. """
+        with self._cond:
+            self._errors.append(exc)
+            self._cond.notify_all()
+
+    def raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def get_group_stats(self):
+        with self._cond:
+            return dict((group, state.to_dict())
+                        for (group, state) in self._groups.items())
+
+
+def run(fn, items, concurrency=10, callback=None, group_key=None,
+        group_concurrency=None, order=ORDER_FIFO, expected_durations=None,
+        lookahead=None, item_size=None):
+    """ Calls `fn(item)` for each of the given items from `concurrency`
+    threads. The items are consumed lazily, so generators of any length can
+    be passed.
+
+    Items can be split in groups (e.g. by OS type), each with its own queue
+    and concurrency limit, so that slow groups don't hold back fast ones.
+
+    :param callback: called as callback(index, item, result, exc, latency)
+        after each call, from the thread which made it; `exc` is the raised
+        exception or None
+    :param group_key: callable returning the group of an item
+    :param group_concurrency: dict with the maximum number of concurrent
+        calls per group, `concurrency` being used for the missing ones
+    :param order: which group to run next when several can: ORDER_FIFO
+        follows the items' order, ORDER_SHORTEST_FIRST and
+        ORDER_LONGEST_FIRST prefer the groups with the shortest or longest
+        expected call duration
+    :param expected_durations: dict with the initial expected call duration
+        per group in seconds, refined with the measured ones
+    :param lookahead: maximum number of items read ahead of the running
+        ones to fill the group queues, defaults to 100 times `concurrency`.
+        While all the queued items belong to groups at their concurrency
+        limit, up to 10 times as many are read to find runnable ones.
+    :param item_size: callable returning the number of units of work an
+        item holds, such as the length of a batch, counted instead of the
+        items by the lookahead
+    :returns: dict with the calls, errors, mean duration, elapsed time and
+        throughput of each group, with 0 skipped items, see add_skipped()
+    :raises: the first exception raised by `callback` or `group_key`, or
+        ValueError for an invalid concurrency, after the running calls
+        completed
+    """
+    scheduler = _Scheduler(
+        items, concurrency, group_key, group_concurrency, order,
+        expected_durations, lookahead or concurrency * 100, item_size)
+
+    def _run_items():
+        while True:
+            picked = scheduler.next()
+            if picked is None:
+                return
+            group, index, item = picked
+            start = time.time()
+            result = exc = None
+            try:
+                result = fn(item)
+            except Exception as ex:
+                exc = ex
+            latency = time.time() - start
+            try:
+                if callback is not None:
+                    callback(index, item, result, exc, latency)
+            finally:
+                scheduler.done(group, latency, exc is not None)
+
+    def _worker():
+        try:
+            _run_items()
+        except Exception as ex:
+            scheduler.fail(ex)
+
+    workers = [threading.Thread(target=profiling.wrap(tracing.wrap(_worker)))
+               for _ in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    scheduler.raise_errors()
+    return scheduler.get_group_stats()
+
+
+def add_skipped(group_stats, skipped):
+    """ Adds the counts of items skipped before being run, from a dict
+    mapping groups to their number of skipped items, to the group stats
+    returned by run(). """
+    for group, count in skipped.items():
+        if group not in group_stats:
+            group_stats[group] = _GroupState(None, None).to_dict()
+        group_stats[group]['skipped'] += count
+
+
+class BulkResults(dict):
+    """ Dict mapping the items of a bulk run to their result, along with
+    the number of `skipped` items and the per-group stats of the run. """
+
+    def __init__(self, *args, **kwargs):
+        super(BulkResults, self).__init__(*args, **kwargs)
+        self.skipped = 0
+        self.group_stats = {}
+
+
+def iter_batches(items, batch_size, group_key=None):
+    """ Splits the given iterable in batches of at most `batch_size` items,
+    only holding items of the same group if `group_key` is given.
+
+    :returns: iterator of (group, list of (index, item) tuples) tuples
+    """
+    batches = collections.OrderedDict()
+    for index, item in enumerate(items):
+        group = group_key(item) if group_key else None
+        batch = batches.setdefault(group, [])
+        batch.append((index, item))
+        if len(batch) >= batch_size:
+            yield group, batches.pop(group)
+    for group, batch in batches.items():
+        yield group, batch
+
+
+class LatencyHistogram(object):
+    """ Fixed-size histogram with logarithmic buckets, from 1ms up to about
+    16 minutes with a relative error below 10%. """
+
+    _MIN = 0.001
+    _GROWTH = 1.1
+    _BUCKETS = 146
+
+    def __init__(self):
+        self._counts = array.array('L', [0]) * self._BUCKETS
+        self._max = 0.0
+        self._total = 0.0
+
+    def add(self, latency):
+        if latency <= self._MIN:
+            bucket = 0
+        else:
+            bucket = min(int(math.ceil(math.log(latency / self._MIN,
+                                                self._GROWTH))),
+                         self._BUCKETS - 1)
+        self._counts[bucket] += 1
+        self._max = max(self._max, latency)
+        self._total += latency
+
+    def get_percentile(self, percentile):
+        """ Returns the upper bound of the bucket holding the given
+        percentile, or None if there are no samples. """
+        count = sum(self._counts)
+        if not count:
+            return None
+        rank = percentile / 100.0 * count
+        seen = 0
+        for bucket, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(self._MIN * self._GROWTH ** bucket, self._max)
+        return self._max
+
+    def to_dict(self):
+        count = sum(self._counts)
+        return {
+            'count': count,
+            'mean': self._total / count if count else None,
+            'p50': self.get_percentile(50),
+            'p90': self.get_percentile(90),
+            'p99': self.get_percentile(99),
+            'max': self._max if count else None,
+        }
+
+
+class OutcomeAggregator(object):
+    """ Keeps compact per-instance outcomes of a bulk run.
+
+    Outcomes are addressed by the index of the instance in the run. Each
+    instance costs 5 bytes: a 1 byte outcome code and a 4 byte index in
+    the table of interned messages. Messages are only kept for unsuccessful
+    outcomes, each distinct message being stored once; once `max_messages`
+    distinct messages were seen, further new ones are counted together.
+    Latencies are only kept in a fixed-size histogram.
+
+    :param size: expected number of instances, used to preallocate storage
+    """
+
+    def __init__(self, size=0, max_messages=10000):
+        self._lock = threading.Lock()
+        self._size = size
+        self._codes = array.array('B', [OUTCOME_NOT_RUN]) * size
+        self._message_ids = array.array('I', [_NO_MESSAGE]) * size
+        self._messages = [None, '<other messages>']
+        self._message_table = {}
+        self._message_counts = [0, 0]
+        self._max_messages = max_messages
+        self._outcome_counts = dict((code, 0) for code in OUTCOME_NAMES)
+        self.latencies = LatencyHistogram()
+        self.group_stats = {}
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, index):
+        self._size = max(self._size, index + 1)
+        missing = index + 1 - len(self._codes)
+        if missing > 0:
+            # NOTE: grow geometrically when the size was not known upfront
+            missing = max(missing, len(self._codes))
+            self._codes.extend(array.array('B', [OUTCOME_NOT_RUN]) * missing)
+            self._message_ids.extend(
+                array.array('I', [_NO_MESSAGE]) * missing)
+
+    def _intern(self, message):
+        message_id = self._message_table.get(message)
+        if message_id is None:
+            if len(self._messages) - 2 >= self._max_messages:
+                return _OTHER_MESSAGES
+            message_id = len(self._messages)
+            self._messages.append(message)
+            self._message_counts.append(0)
+            self._message_table[message] = message_id
+        return message_id
+
+    def record(self, index, code, message=None, latency=None):
+        with self._lock:
+            self._grow(index)
+            previous = self._codes[index]
+            if previous != OUTCOME_NOT_RUN:
+                self._outcome_counts[previous] -= 1
+                self._message_counts[self._message_ids[index]] -= 1
+
+            message_id = _NO_MESSAGE
+            if code != OUTCOME_SUCCESS and message is not None:
+                message_id = self._intern(message)
+
+            self._codes[index] = code
+            self._message_ids[index] = message_id
+            self._outcome_counts[code] += 1
+            self._message_counts[message_id] += 1
+            if latency is not None:
+                self.latencies.add(latency)
+
+    def record_result(self, index, success, message, latency=None):
+        """ Records a (success, message) result as returned by the API. """
+        code = OUTCOME_SUCCESS if success else OUTCOME_FAILURE
+        self.record(index, code, message, latency)
+
+    def record_exception(self, index, exc, latency=None):
+        self.record(index, OUTCOME_ERROR,
+                    '%s: %s' % (type(exc).__name__, exc), latency)
+
+    def record_skipped(self, index):
+        self.record(index, OUTCOME_SKIPPED)
+
+    def get_outcome(self, index):
+        """ Returns the (outcome code, message) tuple of an instance. """
+        with self._lock:
+            return (self._codes[index],
+                    self._messages[self._message_ids[index]])
+
+    def iter_unsuccessful(self):
+        """ Yields (index, outcome code, message) for the instances which did
+        not succeed, leaving out the skipped ones. """
+        for index in range(self._size):
+            code, message = self.get_outcome(index)
+            if code not in (OUTCOME_SUCCESS, OUTCOME_SKIPPED):
+                yield index, code, message
+
+    def get_summary(self, top=10):
+        """ Returns the counts by outcome, the `top` most frequent error
+        messages, the latency distribution and the per-group stats of the
+        run, if any. """
+        with self._lock:
+            top_messages = sorted(
+                ((count, message_id)
+                 for message_id, count in enumerate(self._message_counts)
+                 if message_id != _NO_MESSAGE and count),
+                reverse=True)[:top]
+            summary = {
+                'total': self._size,
+                'outcomes': dict(
+                    (OUTCOME_NAMES[code], count)
+                    for code, count in self._outcome_counts.items()
+                    if code != OUTCOME_NOT_RUN),
+                'top_messages': [
+                    (self._messages[message_id], count)
+                    for count, message_id in top_messages],
+                'latency': self.latencies.to_dict(),
+                'groups': dict(self.group_stats),
+            }
+        outcomes = summary['outcomes']
+        outcomes[OUTCOME_NAMES[OUTCOME_NOT_RUN]] = (
+            summary['total'] - sum(outcomes.values()))
+        return summary
@@ -0,0 +1,153 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Command-line interface sub-commands related to load generation.
+"""
+
+import itertools
+import json
+import uuid
+
+from cliff import show
+from keystoneauth1 import session
+
+from novaguestclient import bench
+from novaguestclient import client
+from novaguestclient import exceptions
+
+OPERATION_APPLY_NETWORKING = 'apply-networking'
+OPERATION_GET = 'get'
+
+
+def _format_latency(value):
+    if value is None:
+        return '-'
+    return '%.2f' % (value * 1000)
+
+
+def _format_rate(value):
+    if value is None:
+        return '-'
+    return '%.2f' % value
+
+
+class Bench(show.ShowOne):
+    """Drives a guest-agent operation at a fixed concurrency or rate and
+    reports throughput, latency percentiles and errors"""
+
+    auth_required = False
+
+    def get_parser(self, prog_name):
+        parser = super(Bench, self).get_parser(prog_name)
+        parser.add_argument('--operation',
+                            choices=[OPERATION_APPLY_NETWORKING,
+                                     OPERATION_GET],
+                            default=OPERATION_APPLY_NETWORKING,
+                            help='The operation to drive')
+        parser.add_argument('--instance-id', action='append',
+                            dest='instance_ids', default=[],
+                            help='Instance id to apply networking on, can '
+                                 'be repeated to cycle through several '
+                                 'instances. Defaults to a random id.')
+        parser.add_argument('--path', default='/',
+                            help='The path requested by the get operation')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of concurrent callers')
+        parser.add_argument('--rate', type=float,
+                            help='Fixed number of requests started per '
+                                 'second, instead of as fast as possible')
+        parser.add_argument('--duration', type=float,
+                            help='Duration of the run in seconds')
+        parser.add_argument('--requests', type=int,
+                            help='Total number of requests to send')
+        parser.add_argument('--summary-file',
+                            help='Write the JSON summary of the run to '
+                                 'this file')
+        parser.add_argument('--stand-in', action='store_true',
+                            help='Run against a local stand-in guest agent '
+                                 'instead of the configured endpoint')
+        parser.add_argument('--stand-in-latency', type=float, default=0.0,
+                            help='Seconds the stand-in server waits before '
+                                 'answering')
+        return parser
+
+    def _get_operation(self, guest_client, args):
+        if args.operation == OPERATION_GET:
+            return lambda: guest_client.http_client.get(args.path)
+
+        instance_ids = itertools.cycle(
+            args.instance_ids or [str(uuid.uuid4())])
+
+        def _apply_networking():
+            success, message = guest_client.networking.apply_networking(
+                next(instance_ids))
+            if not success:
+                raise exceptions.EndpointConnectionValidationFailed(message)
+        return _apply_networking
+
+    def take_action(self, args):
+        if args.duration is None and args.requests is None:
+            raise ValueError("Please specify --duration or --requests")
+
+        server = None
+        if args.stand_in:
+            server = bench.StandInServer(latency=args.stand_in_latency)
+            server.start()
+            guest_client = client.Client(
+                session=session.Session(), endpoint=server.endpoint)
+        else:
+            guest_client = self.app.create_client(self.app.options)
+
+        try:
+            result = bench.LoadGenerator(
+                self._get_operation(guest_client, args),
+                concurrency=args.concurrency, rate=args.rate,
+                duration=args.duration, requests=args.requests).run()
+        finally:
+            if server is not None:
+                server.stop()
+
+        summary = result.to_dict()
+        summary['operation'] = args.operation
+        summary['concurrency'] = args.concurrency
+        if args.summary_file:
+            with open(self.app.resolve_path(args.summary_file), 'w') as fout:
+                json.dump(summary, fout, indent=2, sort_keys=True)
+
+        latency = summary['latency']
+        errors = ', '.join(
+            '%s: %d' % item for item in sorted(
+                summary['errors_by_type'].items())) or '-'
+        columns = ('Operation', 'Requests', 'Successes', 'Errors',
+                   'Elapsed (s)', 'Throughput (req/s)',
+                   'Requested rate (req/s)', 'Achieved rate (req/s)',
+                   'Latency min (ms)',
+                   'Latency p50 (ms)', 'Latency p90 (ms)',
+                   'Latency p95 (ms)', 'Latency p99 (ms)',
+                   'Latency max (ms)', 'Errors by type')
+        data = (summary['operation'], summary['requests'],
+                summary['successes'], summary['errors'],
+                '%.2f' % summary['elapsed'],
+                '%.2f' % summary['throughput'],
+                _format_rate(summary['requested_rate']),
+                _format_rate(summary['achieved_rate']),
+                _format_latency(latency['min']),
+                _format_latency(latency['p50']),
+                _format_latency(latency['p90']),
+                _format_latency(latency['p95']),
+                _format_latency(latency['p99']),
+                _format_latency(latency['max']),
+                errors)
+        return columns, data
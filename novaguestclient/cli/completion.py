@@ -0,0 +1,63 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Command-line interface sub-commands related to the shell completion cache.
+"""
+
+from cliff import lister
+
+from novaguestclient import completion
+
+_KINDS = (completion.KIND_INSTANCE, completion.KIND_EXPORT,
+          completion.KIND_IMPORT)
+
+
+def _get_cache(app):
+    cache = app.get_completion_cache(app.options)
+    if cache is None:
+        raise ValueError("The completion cache is disabled")
+    return cache
+
+
+class RefreshCache(lister.Lister):
+    """Lists the resources of the current project into the shell
+    completion cache, dropping the ones which no longer exist"""
+
+    def take_action(self, args):
+        cache = _get_cache(self.app)
+        counts = cache.refresh(self.app.client_manager.guestagent)
+        return (('Kind', 'Count'), sorted(counts.items()))
+
+
+class LookupCache(lister.Lister):
+    """Lists the cached IDs and human IDs starting with a prefix, without
+    any API calls"""
+
+    auth_required = False
+
+    def get_parser(self, prog_name):
+        parser = super(LookupCache, self).get_parser(prog_name)
+        parser.add_argument('kind', choices=_KINDS,
+                            help='The kind of resource')
+        parser.add_argument('prefix', nargs='?', default='',
+                            help='The prefix to complete')
+        parser.add_argument('--limit', type=int,
+                            help='Maximum number of values to list')
+        return parser
+
+    def take_action(self, args):
+        cache = _get_cache(self.app)
+        values = cache.lookup(args.kind, args.prefix, limit=args.limit)
+        return (('Value',), [(value,) for value in values])
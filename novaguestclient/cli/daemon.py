@@ -0,0 +1,121 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Command-line interface sub-commands related to the nova-guest daemon.
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+
+from cliff import command
+import six
+
+from novaguestclient import client_cache
+from novaguestclient import daemon
+
+
+class _ThreadStreamHandler(logging.StreamHandler):
+    """ Stream handler only emitting the records of the thread which
+    created it, so that concurrent daemon requests don't see each other's
+    log messages.
+    """
+
+    def __init__(self, stream):
+        super(_ThreadStreamHandler, self).__init__(stream)
+        self._thread_id = threading.current_thread().ident
+
+    def filter(self, record):
+        if record.thread != self._thread_id:
+            return False
+        return super(_ThreadStreamHandler, self).filter(record)
+
+
+class _CommandRunner(object):
+    """ Runs forwarded command lines with a fresh application instance
+    while sharing the command manager and the authenticated clients.
+    """
+
+    def __init__(self, app_class, command_manager, client_pool):
+        self._app_class = app_class
+        self._command_manager = command_manager
+        self.client_pool = client_pool
+
+    def __call__(self, argv, env, cwd=None):
+        stdout = six.StringIO()
+        stderr = six.StringIO()
+        app = self._app_class(
+            environ=env, client_pool=self.client_pool, cwd=cwd,
+            command_manager=self._command_manager,
+            stdout=stdout, stderr=stderr)
+
+        handler = _ThreadStreamHandler(stderr)
+        handler.setLevel(logging.WARNING)
+        handler.setFormatter(logging.Formatter(app.CONSOLE_MESSAGE_FORMAT))
+        # NOTE: cliff adds its own console handler on each run, which would
+        # end up accumulating on the daemon's root logger
+        app.configure_logging = lambda: None
+        root_logger = logging.getLogger()
+        root_logger.addHandler(handler)
+        try:
+            if app.is_local_command(argv):
+                return None
+            status = app.run(argv)
+        except SystemExit as ex:
+            # NOTE: argparse exits on '--help', '--version' and usage errors
+            status = ex.code if isinstance(ex.code, int) else 1
+        finally:
+            root_logger.removeHandler(handler)
+
+        return status, stdout.getvalue(), stderr.getvalue()
+
+
+class Daemon(command.Command):
+    """Serves nova-guest commands from a local socket, keeping the
+    authenticated clients warm between invocations"""
+
+    auth_required = False
+
+    def get_parser(self, prog_name):
+        parser = super(Daemon, self).get_parser(prog_name)
+        parser.add_argument('--socket',
+                            default=os.environ.get(
+                                daemon.DAEMON_SOCKET_ENV,
+                                daemon.get_default_socket_path()),
+                            help='Path of the Unix socket to listen on. '
+                                 'Defaults to env[%s].' %
+                                 daemon.DAEMON_SOCKET_ENV)
+        parser.add_argument('--max-clients', type=int, default=64,
+                            help='Maximum number of authenticated clients '
+                                 'kept warm')
+        parser.add_argument('--client-ttl', type=float, default=3600,
+                            help='Seconds after which a client is '
+                                 'authenticated anew')
+        return parser
+
+    def take_action(self, args):
+        runner = _CommandRunner(
+            type(self.app), self.app.command_manager,
+            client_cache.ClientCache(max_size=args.max_clients,
+                                     ttl=args.client_ttl))
+        server = daemon.Daemon(args.socket, runner)
+        # NOTE: exit through the server's cleanup so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,83 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Command-line interface sub-commands related to instance exports.
+"""
+
+from cliff import show
+
+from novaguestclient.v1 import exports
+
+_MIB = 1024 * 1024
+
+
+class Download(show.ShowOne):
+    """Downloads the disk image of an instance export, resuming a previous
+    interrupted download of the same file"""
+
+    def get_parser(self, prog_name):
+        parser = super(Download, self).get_parser(prog_name)
+        parser.add_argument('export_id', help='The export id')
+        parser.add_argument('file', help='Path of the downloaded file')
+        parser.add_argument('--chunk-size', type=int,
+                            default=exports.DEFAULT_CHUNK_SIZE // _MIB,
+                            help='Size in MiB of the ranges requested in '
+                                 'parallel, unless set by the export')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Number of ranges downloaded in parallel')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Attempts per range after a failure')
+        parser.add_argument('--no-resume', dest='resume',
+                            action='store_false',
+                            help='Download the whole file again instead of '
+                                 'resuming a previous download')
+        parser.add_argument('--no-progress', dest='progress',
+                            action='store_false',
+                            help='Do not report the progress on stderr')
+        return parser
+
+    def _report_progress(self, done, total):
+        percent = 100.0 * done / total if total else 100.0
+        self.app.stderr.write('\r%.1f / %.1f MiB (%.1f%%)' % (
+            float(done) / _MIB, float(total) / _MIB, percent))
+        if done == total:
+            self.app.stderr.write('\n')
+        self.app.stderr.flush()
+
+    def take_action(self, args):
+        export_manager = self.app.client_manager.guestagent.exports
+        report = export_manager.download(
+            args.export_id, self.app.resolve_path(args.file),
+            chunk_size=args.chunk_size * _MIB,
+            concurrency=args.concurrency, resume=args.resume,
+            retries=args.retries,
+            progress_callback=self._report_progress if args.progress
+            else None)
+
+        throughput = report['throughput']
+        columns = ('Export ID', 'File', 'Size (MiB)', 'Chunks',
+                   'Resumed (MiB)', 'Downloaded (MiB)', 'Verified chunks',
+                   'Retries', 'Elapsed (s)', 'Throughput (MiB/s)')
+        data = (report['export_id'],
+                report['path'],
+                '%.1f' % (float(report['size']) / _MIB),
+                report['chunks'],
+                '%.1f' % (float(report['resumed_bytes']) / _MIB),
+                '%.1f' % (float(report['downloaded_bytes']) / _MIB),
+                report['verified_chunks'],
+                report['retries'],
+                '%.2f' % report['elapsed'],
+                '%.1f' % (throughput / _MIB) if throughput else '-')
+        return columns, data
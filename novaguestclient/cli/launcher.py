@@ -0,0 +1,54 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Entry point of the nova-guest command.
+
+When a daemon socket is configured, the command line is forwarded to the
+daemon before importing the client, keystoneauth and cliff, or scanning the
+command plugins, which only happens if the command runs locally.
+"""
+
+import sys
+import time
+
+from novaguestclient import daemon
+from novaguestclient import exceptions
+
+
+def main(argv=sys.argv[1:]):
+    socket_path, forwarded_argv = daemon.pop_socket_path_from_argv(argv)
+    if socket_path:
+        try:
+            status = daemon.forward_command(
+                socket_path, forwarded_argv, sys.stdout, sys.stderr)
+        except exceptions.DaemonNotRunning:
+            # NOTE: the shell reports it, unless the command runs locally
+            # anyway, e.g. the daemon command starting the daemon
+            status = None
+        except Exception as ex:
+            sys.stderr.write('%s\n' % ex)
+            return 1
+        if status is not None:
+            return status
+
+    start = time.time()
+    from novaguestclient.cli import shell
+    from novaguestclient import profiling
+    return shell.main(argv, startup_phases={
+        profiling.PHASE_IMPORTS: time.time() - start})
+
+
+if __name__ == '__main__':   # pragma: no cover
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Command-line interface sub-commands related to the local results mirror.
+"""
+
+import time
+
+from cliff import lister
+
+from novaguestclient import mirror
+from novaguestclient.cli import formatter
+
+
+def _add_database_argument(parser, app):
+    parser.add_argument('--database',
+                        default=mirror.get_default_path(app.environ),
+                        help='Path of the local mirror database. '
+                             'Defaults to env[%s].' % mirror.MIRROR_DB_ENV)
+
+
+def _format_time(timestamp):
+    return mirror.to_isotime(timestamp) if timestamp is not None else None
+
+
+class SyncFormatter(formatter.EntityFormatter):
+
+    columns = ("Kind",
+               "Region",
+               "Synced",
+               "Watermark",
+               )
+
+    def _get_formatted_data(self, obj):
+        data = (obj["kind"],
+                obj["region"],
+                obj["synced"],
+                _format_time(obj["watermark"]),
+                )
+        return data
+
+
+class ResultFormatter(formatter.EntityFormatter):
+
+    columns = ("Resource ID",
+               "Kind",
+               "Region",
+               "Success",
+               "Message",
+               "Updated At",
+               )
+
+    def _get_formatted_data(self, obj):
+        data = (obj["resource_id"],
+                obj["kind"],
+                obj["region"],
+                None if obj["success"] is None else bool(obj["success"]),
+                obj["message"],
+                _format_time(obj["updated_at"]),
+                )
+        return data
+
+
+class Sync(lister.Lister):
+    """Fetches the results updated since the last sync into the local
+    mirror"""
+
+    def get_parser(self, prog_name):
+        parser = super(Sync, self).get_parser(prog_name)
+        _add_database_argument(parser, self.app)
+        return parser
+
+    def take_action(self, args):
+        guest_client = self.app.client_manager.guestagent
+        region = self.app.options.region_name or ''
+        local_mirror = mirror.Mirror(self.app.resolve_path(args.database))
+        try:
+            synced = local_mirror.sync_client(guest_client, region)
+            rows = [{'kind': kind, 'region': region, 'synced': count,
+                     'watermark': local_mirror.get_watermark(kind, region)}
+                    for kind, count in sorted(synced.items())]
+        finally:
+            local_mirror.close()
+        return SyncFormatter().list_objects(rows)
+
+
+class ListResults(lister.Lister):
+    """Lists results from the local mirror, without any API calls"""
+
+    auth_required = False
+
+    def get_parser(self, prog_name):
+        parser = super(ListResults, self).get_parser(prog_name)
+        _add_database_argument(parser, self.app)
+        parser.add_argument('--kind', default=mirror.KIND_NETWORKING,
+                            choices=sorted(mirror.SYNCED_MANAGERS),
+                            help='The kind of results to list')
+        status_group = parser.add_mutually_exclusive_group()
+        status_group.add_argument('--failed', dest='success',
+                                  action='store_false', default=None,
+                                  help='Only list failed results')
+        status_group.add_argument('--succeeded', dest='success',
+                                  action='store_true',
+                                  help='Only list successful results')
+        parser.add_argument('--region',
+                            help='Only list results from this region')
+        parser.add_argument('--since-hours', type=float,
+                            help='Only list results updated in the given '
+                                 'number of past hours')
+        parser.add_argument('--limit', type=int,
+                            help='Maximum number of results to list')
+        return parser
+
+    def take_action(self, args):
+        since = None
+        if args.since_hours is not None:
+            since = time.time() - args.since_hours * 3600
+        local_mirror = mirror.Mirror(self.app.resolve_path(args.database))
+        try:
+            rows = local_mirror.query(
+                kind=args.kind, success=args.success, region=args.region,
+                since=since, limit=args.limit)
+        finally:
+            local_mirror.close()
+        return ResultFormatter().list_objects(rows)
@@ -17,9 +17,11 @@
 Command-line interface to the NovaGuestAgent API.
 """
 
+import argparse
 import logging
 import os
 import sys
+import time
 from collections import namedtuple
 
 from cliff import app
@@ -35,6 +37,11 @@ from keystoneauth1.identity import v3
 import six
 
 from novaguestclient import client
+from novaguestclient import client_cache
+from novaguestclient import completion
+from novaguestclient import daemon
+from novaguestclient import profiling
+from novaguestclient import tracing
 from novaguestclient import version
 
 
@@ -42,12 +49,55 @@ _DEFAULT_IDENTITY_API_VERSION = '3'
 _IDENTITY_API_VERSION_2 = ['2', '2.0']
 _IDENTITY_API_VERSION_3 = ['3']
 
+# Global options which determine the created client, used to look up
+# already authenticated clients when running inside the daemon
+_CLIENT_OPTION_KEYS = (
+    'no_auth', 'os_identity_api_version', 'os_auth_url', 'os_username',
+    'os_user_id', 'os_password', 'os_user_domain_id', 'os_user_domain_name',
+    'os_tenant_name', 'os_tenant_id', 'os_project_id', 'os_project_name',
+    'os_project_domain_id', 'os_project_domain_name', 'os_auth_token',
+    'endpoint', 'interface', 'service_type', 'service_name', 'region_name',
+    'novaguestagent_api_version', 'insecure', 'os_cacert', 'os_cert',
+    'os_key', 'timeout', 'no_completion_cache', 'completion_cache_dir')
+# Global options only kept hashed in the client keys
+_SECRET_CLIENT_OPTION_KEYS = ('os_password', 'os_auth_token')
+
+
+def _trace_id(value):
+    trace_id = value.lower()
+    if not tracing.is_valid_trace_id(trace_id):
+        raise argparse.ArgumentTypeError(
+            "invalid trace id '%s', expected 32 hexadecimal characters, "
+            "not all zeros" % value)
+    return trace_id
+
 
 class NovaGuestAgent(app.App):
     """NovaGuestAgent command line interface."""
 
-    def __init__(self, **kwargs):
+    def __init__(self, environ=None, client_pool=None, cwd=None,
+                 startup_phases=None, **kwargs):
+        """
+        :param environ: mapping used for the option defaults instead of
+            os.environ
+        :param client_pool: optional object, such as a ClientCache, with
+            get_or_create(key, create_fn) and release(client) methods used
+            to reuse clients between commands
+        :param cwd: directory relative paths are resolved against instead
+            of the current working directory, e.g. the one of the process
+            which forwarded the command to the daemon
+        :param startup_phases: dict with the seconds spent in phases before
+            the application was created, e.g. profiling.PHASE_IMPORTS,
+            reported when profiling
+        """
         self.client = None
+        self._profiler = None
+        self._command_span = None
+        self._environ = os.environ if environ is None else environ
+        self.cwd = cwd or os.getcwd()
+        self._client_pool = client_pool
+        self._pooled_client = None
+        self._startup_phases = dict(startup_phases or {})
 
         # Patch command.Command to add a default auth_required = True
         command.Command.auth_required = True
@@ -56,11 +106,17 @@ class NovaGuestAgent(app.App):
         help.HelpCommand.auth_required = False
         complete.CompleteCommand.auth_required = False
 
+        command_manager = kwargs.pop('command_manager', None)
+        if command_manager is None:
+            start = time.time()
+            command_manager = commandmanager.CommandManager('guestagent.v1')
+            self._startup_phases[profiling.PHASE_PLUGINS] = (
+                time.time() - start)
+
         super(NovaGuestAgent, self).__init__(
             description=__doc__.strip(),
             version=version.__version__,
-            command_manager=commandmanager.CommandManager(
-                'guestagent.v1'),
+            command_manager=command_manager,
             deferred_help=True,
             **kwargs
         )
@@ -145,9 +201,10 @@ class NovaGuestAgent(app.App):
                 )
             method = v3.Token if auth_type == 'token' else v3.Password
 
-        auth = method(**kwargs)
-
-        return session.Session(auth=auth, verify=not args.insecure)
+        with tracing.span('keystone.session', auth_type=auth_type,
+                          identity_api_version=api_version):
+            auth = method(**kwargs)
+            return session.Session(auth=auth, verify=not args.insecure)
 
     def create_client(self, args):
         created_client = None
@@ -170,6 +227,7 @@ class NovaGuestAgent(app.App):
                 endpoint=args.endpoint,
                 project_id=args.os_tenant_id or args.os_project_id,
                 verify=not args.insecure,
+                completion_cache=self.get_completion_cache(args),
                 **endpoint_filter_kwargs
             )
         # Token-based authentication
@@ -186,6 +244,7 @@ class NovaGuestAgent(app.App):
             created_client = client.Client(
                 session=session,
                 endpoint=args.endpoint,
+                completion_cache=self.get_completion_cache(args),
                 **endpoint_filter_kwargs
             )
 
@@ -203,6 +262,7 @@ class NovaGuestAgent(app.App):
             created_client = client.Client(
                 session=session,
                 endpoint=args.endpoint,
+                completion_cache=self.get_completion_cache(args),
                 **endpoint_filter_kwargs
             )
         else:
@@ -210,6 +270,26 @@ class NovaGuestAgent(app.App):
 
         return created_client
 
+    def get_completion_cache(self, args):
+        """ Returns the completion cache of the project selected by the
+        global options, or None if disabled. """
+        if args.no_completion_cache:
+            return None
+        scope = (args.os_auth_url or args.endpoint,
+                 args.os_project_id or args.os_tenant_id or
+                 args.os_project_name or args.os_tenant_name)
+        return completion.CompletionCache(
+            scope, path=self.resolve_path(args.completion_cache_dir))
+
+    def get_client_key(self, args):
+        client_key = []
+        for key in _CLIENT_OPTION_KEYS:
+            value = getattr(args, key, None)
+            if value is not None and key in _SECRET_CLIENT_OPTION_KEYS:
+                value = client_cache.hash_secret(value)
+            client_key.append((key, value))
+        return tuple(client_key)
+
     def _get_endpoint_filter_kwargs(self, args):
         endpoint_filter_keys = ('interface', 'service_type', 'service_name',
                                 'novaguestagent_api_version', 'region_name')
@@ -315,14 +395,75 @@ class NovaGuestAgent(app.App):
                             metavar='<novaguestagent-api-version>',
                             default=self._env('NOVAGUESTAGENT_API_VERSION'),
                             help='Defaults to env[NOVAGUESTAGENT_API_VERSION].')
+        parser.add_argument(daemon.DAEMON_SOCKET_OPTION,
+                            metavar='<daemon-socket>',
+                            help='Run the command through the nova-guest '
+                                 'daemon listening on the given socket. '
+                                 'Defaults to env[%s].' %
+                                 daemon.DAEMON_SOCKET_ENV)
+        parser.add_argument('--profile',
+                            metavar='<stats-file>',
+                            help='Profile the command with cProfile and '
+                                 'write the stats to the given file.')
+        parser.add_argument('--trace-malloc',
+                            metavar='<snapshot-file>',
+                            help='Trace the memory allocations of the '
+                                 'command and write the top allocation '
+                                 'sites to the given file.')
+        parser.add_argument('--trace-malloc-top',
+                            metavar='<count>', type=int, default=25,
+                            help='Number of allocation sites reported by '
+                                 '--trace-malloc. Defaults to 25.')
+        parser.add_argument('--trace-file',
+                            metavar='<trace-file>',
+                            default=self._env('NOVAGUEST_TRACE_FILE'),
+                            help='Append the trace spans of the command as '
+                                 'JSON lines to the given file. '
+                                 'Defaults to env[NOVAGUEST_TRACE_FILE].')
+        parser.add_argument('--trace-id',
+                            metavar='<trace-id>', type=_trace_id,
+                            default=self._env('NOVAGUEST_TRACE_ID'),
+                            help='Trace id to attach the spans to, e.g. the '
+                                 'one of the calling orchestrator. '
+                                 'Defaults to env[NOVAGUEST_TRACE_ID].')
+        parser.add_argument('--completion-cache-dir',
+                            metavar='<completion-cache-dir>',
+                            default=completion.get_default_dir(
+                                self._environ),
+                            help='Directory of the shell completion cache, '
+                                 'updated by the list and get calls. '
+                                 'Defaults to env[%s].' %
+                                 completion.COMPLETION_CACHE_ENV)
+        parser.add_argument('--no-completion-cache', action='store_true',
+                            help='Do not update the shell completion '
+                                 'cache.')
         parser.epilog = ('See "novaguestagent help COMMAND" for help '
                          'on a specific command.')
         loading.register_session_argparse_arguments(parser)
 
         return parser
 
+    @property
+    def environ(self):
+        return self._environ
+
     def _env(self, var_name, default=None):
-        return os.environ.get(var_name, default)
+        return self._environ.get(var_name, default)
+
+    def is_local_command(self, argv):
+        """ Returns whether the command line given by `argv` must not be
+        forwarded to the daemon: the daemon command itself, and the
+        interactive mode started without a command, which reads the
+        terminal. """
+        _, remainder = self.parser.parse_known_args(argv)
+        return remainder[:1] in ([], ['daemon'])
+
+    def resolve_path(self, path):
+        """ Returns the given path made absolute against the working
+        directory of the command. """
+        if path is None:
+            return None
+        return os.path.join(self.cwd, os.path.expanduser(path))
 
     def prepare_to_run_command(self, cmd):
         """Prepares to run the command
@@ -330,10 +471,72 @@ class NovaGuestAgent(app.App):
         client interface.
         This is inherited from the framework.
         """
+        if self._profiler is not None:
+            self._profile_formatting(cmd)
+
+        if self.options.trace_file:
+            tracing.configure(
+                tracing.FileExporter(
+                    self.resolve_path(self.options.trace_file)),
+                trace_id=self.options.trace_id or tracing.new_trace_id())
+            self._command_span = tracing.span(
+                'command', command=getattr(cmd, 'cmd_name', None))
+
         self.client_manager = namedtuple(
             'ClientManager', 'guestagent')
         if cmd.auth_required:
-            self.client_manager.guestagent = self.create_client(self.options)
+            if self._client_pool is not None:
+                self._pooled_client = self._client_pool.get_or_create(
+                    self.get_client_key(self.options),
+                    lambda: self.create_client(self.options))
+                self.client_manager.guestagent = self._pooled_client
+            else:
+                self.client_manager.guestagent = self.create_client(
+                    self.options)
+
+    def _start_profiler(self):
+        self._profiler = profiling.Profiler(
+            profile_file=self.resolve_path(self.options.profile),
+            trace_malloc_file=self.resolve_path(self.options.trace_malloc),
+            top=self.options.trace_malloc_top)
+        for name, elapsed in self._startup_phases.items():
+            self._profiler.add_phase(name, elapsed, None)
+        self._profiler.start()
+
+    def _stop_profiler(self):
+        if self._profiler is not None:
+            profiler, self._profiler = self._profiler, None
+            profiler.stop()
+            self.stderr.write(profiler.format_report())
+
+    def _profile_formatting(self, cmd):
+        produce_output = getattr(cmd, 'produce_output', None)
+        if produce_output is not None:
+            def _produce_output(*args, **kwargs):
+                with profiling.phase(profiling.PHASE_FORMATTING):
+                    return produce_output(*args, **kwargs)
+            cmd.produce_output = _produce_output
+
+    def run_subcommand(self, argv):
+        """ Runs the command, profiled from its lookup on, so that the
+        import of its module is included. """
+        if self.options.profile or self.options.trace_malloc:
+            self._start_profiler()
+        try:
+            return super(NovaGuestAgent, self).run_subcommand(argv)
+        finally:
+            self._stop_profiler()
+
+    def clean_up(self, cmd, result, err):
+        if self._command_span is not None:
+            command_span, self._command_span = self._command_span, None
+            command_span.set_attribute('result', result)
+            command_span.finish(error=err)
+            tracing.disable()
+        if self._pooled_client is not None:
+            pooled_client, self._pooled_client = self._pooled_client, None
+            self._client_pool.release(pooled_client)
+        super(NovaGuestAgent, self).clean_up(cmd, result, err)
 
     def run(self, argv):
         # If no arguments are provided, usage is displayed
@@ -348,9 +551,19 @@ def _setup_logging():
     logging.getLogger("keystoneclient").setLevel(logging.ERROR)
 
 
-def main(argv=sys.argv[1:]):
+def main(argv=sys.argv[1:], startup_phases=None):
+    socket_path, forwarded_argv = daemon.pop_socket_path_from_argv(argv)
+    novaguestagent_app = NovaGuestAgent(startup_phases=startup_phases)
+    if socket_path and not novaguestagent_app.is_local_command(
+            forwarded_argv):
+        try:
+            return daemon.forward_command(
+                socket_path, forwarded_argv, sys.stdout, sys.stderr)
+        except Exception as ex:
+            sys.stderr.write('%s\n' % ex)
+            return 1
+
     _setup_logging()
-    novaguestagent_app = NovaGuestAgent()
     return novaguestagent_app.run(argv)
 
 
@@ -21,6 +21,13 @@ import uuid
 
 from novaguestclient import constants
 
+_JSON_READ_SIZE = 64 * 1024
+_JSON_WHITESPACE = ' \t\n\r'
+_JSON_DELIMITERS = _JSON_WHITESPACE + ',]}'
+# Errors this far from the end of the buffer can not come from a token cut
+# short by it, the longest one being '-Infinity'
+_JSON_MAX_TRUNCATED_TOKEN = len('-Infinity')
+
 
 def format_json_for_object_property(obj, prop_name):
     """ Returns the property given by `prop_name` of the given
@@ -54,10 +61,40 @@ def validate_uuid_string(uuid_obj, uuid_version=4):
     return True
 
 
-def add_args_for_json_option_to_parser(parser, option_name):
+def positive_int(string):
+    """ argparse type for integers greater than zero. """
+    try:
+        value = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid int value: '%s'" % string)
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "must be greater than zero, got %d" % value)
+    return value
+
+
+class _FileType(argparse.FileType):
+    """ argparse.FileType opening relative paths from the given directory
+    rather than from the current working directory. """
+
+    def __init__(self, mode='r', cwd=None):
+        super(_FileType, self).__init__(mode)
+        self._cwd = cwd
+
+    def __call__(self, string):
+        if self._cwd and string != '-':
+            string = os.path.join(self._cwd, os.path.expanduser(string))
+        return super(_FileType, self).__call__(string)
+
+
+def add_args_for_json_option_to_parser(parser, option_name, cwd=None):
     """ Given an `argparse.ArgumentParser` instance, dynamically add a group of
     arguments for the option for both an '--option-name' and
     '--option-name-file'.
+
+    :param cwd: directory relative file paths are opened from, such as the
+        application's cwd when running in the daemon
     """
     option_name = option_name.replace('_', '-')
     option_label_name = option_name.replace('-', ' ')
@@ -65,12 +102,137 @@ def add_args_for_json_option_to_parser(parser, option_name):
     arg_group.add_argument('--%s' % option_name,
                            help='JSON encoded %s data' % option_label_name)
     arg_group.add_argument('--%s-file' % option_name,
-                           type=argparse.FileType('r'),
+                           type=_FileType('r', cwd),
                            help='Relative/full path to a file containing the '
                                 '%s data in JSON format' % option_label_name)
     return parser
 
 
+class _JSONStreamReader(object):
+    """ Reads the values of a JSON document from a text file one at a time,
+    only keeping the part of the document which was read but not parsed
+    yet in memory. Errors report their location in the file. """
+
+    def __init__(self, fin, read_size=_JSON_READ_SIZE):
+        self._fin = fin
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        # NOTE: location in the file of the start of the buffer
+        self._offset = 0
+        self._line = 1
+        self._line_offset = 0
+
+    def _fill(self, size=None):
+        """ Drops the parsed part of the buffer and reads more data, returning
+        False at the end of the file. """
+        if self._eof:
+            return False
+        parsed = self._buffer[:self._pos]
+        newlines = parsed.count('\n')
+        if newlines:
+            self._line += newlines
+            self._line_offset = self._offset + parsed.rindex('\n') + 1
+        self._offset += self._pos
+
+        data = self._fin.read(max(size or 0, self._read_size))
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        self._eof = not data
+        return bool(data)
+
+    def _get_error(self, message, pos=None):
+        pos = self._pos if pos is None else pos
+        text = self._buffer[:pos]
+        newlines = text.count('\n')
+        line_offset = self._line_offset
+        if newlines:
+            line_offset = self._offset + text.rindex('\n') + 1
+        offset = self._offset + pos
+        return ValueError("%s: line %d column %d (char %d)" % (
+            message, self._line + newlines, offset - line_offset + 1,
+            offset))
+
+    def peek(self):
+        """ Returns the next non-whitespace character, or an empty string at
+        the end of the file. """
+        while True:
+            while (self._pos < len(self._buffer) and
+                    self._buffer[self._pos] in _JSON_WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """ Consumes and returns the next non-whitespace character, which
+        must be one of `chars`. """
+        char = self.peek()
+        if not char or char not in chars:
+            raise self._get_error("Expecting %s" % " or ".join(
+                "'%s'" % c for c in chars))
+        self._pos += 1
+        return char
+
+    def expect_end(self):
+        if self.peek():
+            raise self._get_error("Extra data")
+
+    def _is_truncation_error(self, ex):
+        """ Returns whether a decoding error may come from the value being
+        cut short by the end of the buffer, rather than from invalid data
+        which reading more would not fix. """
+        pos = getattr(ex, 'pos', None)
+        if pos is None or getattr(ex, 'msg', '').startswith(
+                'Unterminated string'):
+            return True
+        return pos + _JSON_MAX_TRUNCATED_TOKEN >= len(self._buffer)
+
+    def read_value(self):
+        """ Parses the next value. Values are only accepted when followed by
+        a delimiter or at the end of the file, as a number could otherwise be
+        cut short by the end of the buffer, e.g. '1.5' out of '1.5e3'. """
+        self.peek()
+        size = self._read_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(
+                    self._buffer, self._pos)
+            except ValueError as ex:
+                if self._eof or not self._is_truncation_error(ex):
+                    raise self._get_error(
+                        getattr(ex, 'msg', str(ex)),
+                        getattr(ex, 'pos', self._pos))
+            else:
+                if self._eof or (end < len(self._buffer) and
+                                 self._buffer[end] in _JSON_DELIMITERS):
+                    self._pos = end
+                    return value
+            self._fill(size)
+            size *= 2
+
+
+def _iter_array_items(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+    else:
+        while True:
+            yield reader.read_value()
+            if reader.expect(',]') == ']':
+                break
+    reader.expect_end()
+
+
+def iter_json_array_items(fin):
+    """ Yields the items of the JSON array stored in the given text file,
+    parsing them as the file is read. """
+    return _iter_array_items(_JSONStreamReader(fin))
+
+
 def get_option_value_from_args(args, option_name, error_on_no_value=True):
     """ Returns a dict with the value from of the option from the given
     arguments as set up by calling `add_args_for_json_option_to_parser`
@@ -78,6 +240,7 @@ def get_option_value_from_args(args, option_name, error_on_no_value=True):
     """
     value = None
     raw_value = None
+    file_name = None
     option_name = option_name.replace('-', '_')
     option_label_name = option_name.replace('_', ' ')
     option_file_name = "%s_file" % option_name
@@ -90,17 +253,63 @@ def get_option_value_from_args(args, option_name, error_on_no_value=True):
     elif file_arg:
         with file_arg as fin:
             raw_value = fin.read()
+            file_name = fin.name
 
     if not value and raw_value:
         try:
             value = json.loads(raw_value)
         except ValueError as ex:
             raise ValueError(
-                "Error while parsing %s JSON: %s" % (
-                    option_label_name, str(ex)))
+                "Error while parsing %s JSON%s: %s" % (
+                    option_label_name,
+                    " from '%s'" % file_name if file_name else "", str(ex)))
 
     if not value and error_on_no_value:
         raise ValueError(
             "No '%s[-file]' parameter was provided." % option_arg_name)
 
     return value
+
+
+def iter_option_items_from_args(args, option_name, error_on_no_value=True):
+    """ Yields the items of the JSON array given through the option's
+    arguments as set up by calling `add_args_for_json_option_to_parser`.
+    Items of '--option-name-file' files are parsed one at a time as the
+    file is read, so that the first ones can be used before reading the
+    rest.
+    """
+    option_name = option_name.replace('-', '_')
+    option_label_name = option_name.replace('_', ' ')
+    file_arg = getattr(args, "%s_file" % option_name)
+    if not file_arg:
+        value = get_option_value_from_args(
+            args, option_name, error_on_no_value=False)
+        if value is not None and not isinstance(value, list):
+            raise ValueError(
+                "The %s JSON must be an array" % option_label_name)
+        if value is None and error_on_no_value:
+            raise ValueError(
+                "No '--%s[-file]' parameter was provided." %
+                option_name.replace('_', '-'))
+        if not value and error_on_no_value:
+            raise ValueError(
+                "The %s JSON array is empty." % option_label_name)
+        for item in value or []:
+            yield item
+        return
+
+    count = 0
+    with file_arg as fin:
+        try:
+            for item in iter_json_array_items(fin):
+                count += 1
+                yield item
+        except ValueError as ex:
+            raise ValueError(
+                "Error while parsing %s JSON from '%s' after %d item(s): "
+                "%s" % (option_label_name, fin.name, count, str(ex)))
+
+    if not count and error_on_no_value:
+        raise ValueError(
+            "The %s JSON array from '%s' is empty." % (
+                option_label_name, fin.name))
@@ -12,11 +12,25 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
+import json
 import logging
+import threading
 
 from keystoneauth1 import adapter
 from keystoneauth1.exceptions.catalog import EndpointNotFound
+from keystoneauth1.exceptions import connection as ks_connection_exceptions
+from keystoneauth1.exceptions import http as ks_http_exceptions
 
+from novaguestclient import constants
+from novaguestclient import exceptions
+from novaguestclient import hedging
+from novaguestclient import profiling
+from novaguestclient import singleflight
+from novaguestclient import token_refresh
+from novaguestclient import tracing
+from novaguestclient.v1 import exports
+from novaguestclient.v1 import imports
 from novaguestclient.v1 import networking
 
 LOG = logging.getLogger(__name__)
@@ -25,9 +39,17 @@ _DEFAULT_SERVICE_TYPE = 'guest-agent'
 _DEFAULT_SERVICE_INTERFACE = 'internal'
 _DEFAULT_API_VERSION = 'v1'
 
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Statuses of the version document request meaning that the API predates it
+_NO_DISCOVERY_STATUSES = (404, 501)
+# Requests passing any other keyword argument are never coalesced
+_COALESCABLE_KWARGS = frozenset(['json', 'headers', 'raise_exc'])
+
 
 class _HTTPClient(adapter.Adapter):
-    def __init__(self, session, project_id=None, **kwargs):
+    def __init__(self, session, project_id=None, coalesce=False,
+                 hedge_percentile=None, hedge_max_ratio=0.1,
+                 completion_cache=None, **kwargs):
         kwargs.setdefault('interface', _DEFAULT_SERVICE_INTERFACE)
         kwargs.setdefault('service_type', _DEFAULT_SERVICE_TYPE)
         kwargs.setdefault('version', _DEFAULT_API_VERSION)
@@ -38,9 +60,191 @@ class _HTTPClient(adapter.Adapter):
         if endpoint:
             self.endpoint_override = '{0}/{1}'.format(endpoint, self.version)
 
+        self._capabilities = None
+        self._capabilities_lock = threading.Lock()
+        self.coalescer = singleflight.SingleFlight() if coalesce else None
+        self.completion_cache = completion_cache
+        self.hedger = None
+        if hedge_percentile is not None:
+            self.hedger = hedging.Hedger(
+                percentile=hedge_percentile, max_extra_ratio=hedge_max_ratio)
+
+    def get_capabilities(self):
+        """ Returns the set of optional features advertised by the guest
+        agent API version document, discovered once and cached. Versions
+        which predate the document are assumed to have none. Other
+        discovery failures are assumed to be transient: no capabilities
+        are reported and the discovery is attempted again on the next
+        call. """
+        with self._capabilities_lock:
+            if self._capabilities is None:
+                try:
+                    body = self.get('').json()
+                except ks_http_exceptions.HttpError as ex:
+                    LOG.debug("API version discovery failed: %s", ex)
+                    if ex.http_status not in _NO_DISCOVERY_STATUSES:
+                        return frozenset()
+                    body = {}
+                except ks_connection_exceptions.ConnectionError as ex:
+                    LOG.debug("API version discovery failed: %s", ex)
+                    return frozenset()
+                version = body.get('version') or {}
+                self._capabilities = frozenset(
+                    version.get('capabilities') or [])
+            return self._capabilities
+
+    def supports(self, capability):
+        return capability in self.get_capabilities()
+
+    def _get_coalescing_key(self, url, method, kwargs):
+        if not set(kwargs).issubset(_COALESCABLE_KWARGS):
+            return None
+        try:
+            body = json.dumps(kwargs.get('json'), sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        # NOTE: coalesced duplicates share the idempotency key of the call
+        # actually sent
+        headers = tuple(sorted(
+            (k, v) for (k, v) in (kwargs.get('headers') or {}).items()
+            if k != constants.IDEMPOTENCY_KEY_HEADER))
+        return (method, url, body, headers, kwargs.get('raise_exc', True))
+
+    def request(self, url, method, **kwargs):
+        """ Sends the request, sharing the response between concurrent
+        identical requests if coalescing is enabled and hedging idempotent
+        reads if hedging is enabled.
+
+        :param idempotent: marks requests using a method which is not
+            idempotent by definition (e.g. POST) as safe to coalesce
+        :param timeout: seconds the call may take, applied to both the
+            connection and the response read
+        :param deadline: absolute time (as returned by time.time()) after
+            which the call fails with DeadlineExceeded
+        """
+        idempotent = kwargs.pop('idempotent', method in _IDEMPOTENT_METHODS)
+        deadline = hedging.get_deadline(
+            kwargs.pop('timeout', None), kwargs.pop('deadline', None))
+
+        if self.coalescer is not None and idempotent:
+            key = self._get_coalescing_key(url, method, kwargs)
+            if key is not None:
+                return self.coalescer.do(
+                    key, self._send, url, method, deadline, kwargs,
+                    deadline=deadline)
+        return self._send(url, method, deadline, kwargs)
+
+    def _send(self, url, method, deadline, kwargs):
+        # NOTE: the body of a streamed response is read after the call, so
+        # the slower of two hedged requests could not be told apart
+        if (self.hedger is not None and method in _IDEMPOTENT_METHODS and
+                not kwargs.get('stream')):
+            return self.hedger.call(
+                functools.partial(
+                    self._send_once, url, method, deadline, kwargs),
+                deadline=deadline)
+        return self._send_once(url, method, deadline, kwargs)
+
+    def _send_once(self, url, method, deadline, kwargs):
+        if profiling.is_active() or tracing.is_enabled():
+            self._resolve_auth_and_endpoint()
+        if deadline is not None:
+            kwargs = dict(kwargs, timeout=hedging.get_remaining_time(deadline))
+
+        with tracing.span('guestagent.request', method=method,
+                          url=url) as span, \
+                profiling.phase(profiling.PHASE_HTTP):
+            if span.recording:
+                headers = dict(kwargs.get('headers') or {})
+                headers.update(span.get_headers())
+                kwargs = dict(kwargs, headers=headers)
+            try:
+                resp = super(_HTTPClient, self).request(
+                    url, method, **kwargs)
+            except ks_connection_exceptions.ConnectTimeout:
+                # NOTE: the timeout is the time left until the deadline
+                if deadline is None:
+                    raise
+                raise exceptions.DeadlineExceeded()
+            span.set_attribute('status_code', resp.status_code)
+            return resp
+
+    def _resolve_auth_and_endpoint(self):
+        """ Authenticates and looks up the endpoint ahead of the request, so
+        that profiling and tracing attribute their cost separately. Both are
+        cached, making the request itself reuse them. """
+        if self.auth or self.session.auth:
+            with tracing.span('keystone.auth'), \
+                    profiling.phase(profiling.PHASE_AUTH):
+                self.get_token()
+        with tracing.span('endpoint.resolve') as span, \
+                profiling.phase(profiling.PHASE_CATALOG):
+            span.set_attribute('endpoint', self.get_endpoint())
+
 
 class Client(object):
     def __init__(self, session=None, *args, **kwargs):
-        httpclient = _HTTPClient(session=session, *args, **kwargs)
+        """
+        :param coalesce: share a single in-flight HTTP call between
+            concurrent identical idempotent requests
+        :param hedge_percentile: if set, GET requests slower than this
+            percentile of the recent latencies are sent a second time and
+            the first response is used
+        :param hedge_max_ratio: maximum ratio of hedged to total requests
+        :param token_refresh_margin: if set, the session's token is
+            refreshed in the background once less than this many seconds
+            are left before it expires, which must be more than the 120
+            seconds before which keystoneauth refreshes it itself
+        :param completion_cache: completion.CompletionCache updated with
+            the resources returned by list and get calls
+        :param ledger: mirror.Mirror recording the last successful action
+            applied on each instance, used to skip unchanged instances in
+            bulk runs
+        """
+        token_refresh_margin = kwargs.pop('token_refresh_margin', None)
+        ledger = kwargs.pop('ledger', None)
+        self.http_client = _HTTPClient(session, *args, **kwargs)
+
+        self.token_refresher = None
+        if (token_refresh_margin is not None and session is not None and
+                session.auth is not None):
+            self.token_refresher = token_refresh.TokenRefresher(
+                session, margin=token_refresh_margin)
+            self.token_refresher.start()
+
+        self.networking = networking.NetworkingManager(
+            self.http_client, ledger=ledger)
+        self.exports = exports.ExportManager(self.http_client)
+        self.imports = imports.ImportManager(self.http_client)
+
+    def close(self):
+        """ Stops the background activity of the client and closes the
+        pooled connections of its session. """
+        if self.token_refresher is not None:
+            self.token_refresher.stop()
+        if self.http_client.hedger is not None:
+            self.http_client.hedger.shutdown()
+        requests_session = getattr(self.http_client.session, 'session', None)
+        if requests_session is not None:
+            requests_session.close()
+
+    def get_token_refresh_stats(self):
+        """ Returns the background token refresh counters, or None if
+        the token is not refreshed in the background. """
+        if self.token_refresher is None:
+            return None
+        return self.token_refresher.get_stats()
+
+    def get_coalescing_stats(self):
+        """ Returns the request coalescing counters, or None if coalescing
+        is disabled. """
+        if self.http_client.coalescer is None:
+            return None
+        return self.http_client.coalescer.get_stats()
 
-        self.networking = networking.NetworkingManager(httpclient)
+    def get_hedging_stats(self):
+        """ Returns the request hedging counters, or None if hedging is
+        disabled. """
+        if self.http_client.hedger is None:
+            return None
+        return self.http_client.hedger.get_stats()
@@ -0,0 +1,228 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bounded cache of Client instances, so that callers acting on behalf of many
+projects reuse authenticated sessions and their connection pools.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+from keystoneauth1 import loading
+from keystoneauth1 import session as ks_session
+import six
+
+from novaguestclient import client
+from novaguestclient import singleflight
+
+LOG = logging.getLogger(__name__)
+
+# Auth options only kept hashed in the cache keys
+_SECRET_AUTH_OPTIONS = ('password', 'token', 'application_credential_secret')
+
+
+def _freeze(options):
+    return tuple(sorted(
+        (k, v) for (k, v) in six.iteritems(options or {}) if v is not None))
+
+
+def hash_secret(value):
+    """ Returns the hash standing for a secret in cache keys, so that the
+    secret itself is not kept in memory along with them. """
+    return hashlib.sha256(six.text_type(value).encode('utf-8')).hexdigest()
+
+
+class ClientCache(object):
+    """ Thread-safe LRU cache of clients with a time to live.
+
+    Clients obtained from the cache are leased until given back with
+    release(). Evicted and expired clients are closed once they are no
+    longer leased, so clients should be used for the duration of a request
+    and not be kept.
+
+    :param max_size: maximum number of cached clients
+    :param ttl: seconds after which a cached client is replaced, or None
+        to keep clients until they are evicted
+    """
+
+    def __init__(self, max_size=64, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._creating = singleflight.SingleFlight()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        # NOTE: lease counts and clients to close once released, by id
+        self._leases = {}
+        self._retired = {}
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _close(self, cached_client):
+        close = getattr(cached_client, 'close', None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as ex:
+            LOG.warning("Failed to close evicted client: %s", ex)
+
+    def _lease(self, cached_client):
+        client_id = id(cached_client)
+        self._leases[client_id] = self._leases.get(client_id, 0) + 1
+
+    def _retire(self, stale_clients):
+        """ Returns the given clients which can be closed right away,
+        the leased ones being closed when released. Called with the lock
+        held. """
+        to_close = []
+        for stale_client in stale_clients:
+            if self._leases.get(id(stale_client)):
+                self._retired[id(stale_client)] = stale_client
+            else:
+                to_close.append(stale_client)
+        return to_close
+
+    def _lookup(self, key):
+        """ Returns the cached client for `key`, leased, if any and not
+        expired, along with a list of the clients which must be closed. """
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is None:
+                return None, []
+            created_at, cached_client = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                self._expirations += 1
+                return None, self._retire([cached_client])
+            # NOTE: re-inserting marks the entry as the most recently used
+            self._clients[key] = entry
+            self._hits += 1
+            self._lease(cached_client)
+            return cached_client, []
+
+    def _store(self, key, new_client):
+        stale_clients = []
+        with self._lock:
+            self._misses += 1
+            previous = self._clients.pop(key, None)
+            if previous is not None and previous[1] is not new_client:
+                stale_clients.append(previous[1])
+            self._clients[key] = (time.time(), new_client)
+            self._lease(new_client)
+            while len(self._clients) > self.max_size:
+                _, (_, evicted) = self._clients.popitem(last=False)
+                self._evictions += 1
+                stale_clients.append(evicted)
+            return self._retire(stale_clients)
+
+    def get_or_create(self, key, create_fn):
+        """ Returns the client cached for `key`, creating it with
+        `create_fn()` if needed, leased until given back with release().
+        Concurrent misses on the same key only create one client. """
+        to_close = []
+        while True:
+            cached_client, stale_clients = self._lookup(key)
+            to_close.extend(stale_clients)
+            if cached_client is not None:
+                break
+            created = []
+
+            def _create():
+                new_client = create_fn()
+                to_close.extend(self._store(key, new_client))
+                created.append(new_client)
+                return new_client
+            self._creating.do(key, _create)
+            if created:
+                cached_client = created[0]
+                break
+            # NOTE: callers which waited for a concurrent creation look the
+            # client up again, to lease it and count the hit
+
+        for stale_client in to_close:
+            self._close(stale_client)
+        return cached_client
+
+    def release(self, cached_client):
+        """ Gives back a client obtained from the cache, closing it if it
+        was evicted or expired meanwhile and is no longer leased. """
+        client_id = id(cached_client)
+        with self._lock:
+            count = self._leases.get(client_id, 0) - 1
+            if count > 0:
+                self._leases[client_id] = count
+                return
+            self._leases.pop(client_id, None)
+            retired = self._retired.pop(client_id, None)
+        if retired is not None:
+            self._close(retired)
+
+    def get_client(self, auth_type='password', auth_options=None,
+                   session_options=None, **client_kwargs):
+        """ Returns a cached client for the given keystone auth plugin
+        options, creating it if needed.
+
+        :param auth_type: keystoneauth plugin name, e.g. 'password'
+        :param auth_options: options of the plugin, e.g. auth_url,
+            username, password, project_id
+        :param session_options: keystoneauth Session options, e.g. verify
+        :param client_kwargs: Client arguments, e.g. the endpoint filters
+            (interface, service_type, region_name, endpoint)
+        :returns: the client, to give back with release() once done
+        """
+        auth_options = dict(auth_options or {})
+        key_auth_options = dict(
+            (k, hash_secret(v) if k in _SECRET_AUTH_OPTIONS else v)
+            for (k, v) in six.iteritems(auth_options))
+        key = (auth_type, _freeze(key_auth_options),
+               _freeze(session_options), _freeze(client_kwargs))
+
+        def _create():
+            loader = loading.get_plugin_loader(auth_type)
+            auth = loader.load_from_options(**auth_options)
+            session = ks_session.Session(
+                auth=auth, **dict(session_options or {}))
+            return client.Client(session=session, **client_kwargs)
+
+        return self.get_or_create(key, _create)
+
+    def clear(self):
+        with self._lock:
+            to_close = self._retire(
+                [cached_client for (_, cached_client)
+                 in self._clients.values()])
+            self._clients.clear()
+        for cached_client in to_close:
+            self._close(cached_client)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._clients),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'hit_rate': float(self._hits) / lookups if lookups else None,
+            }
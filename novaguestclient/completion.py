@@ -0,0 +1,323 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local cache of resource IDs and human IDs for shell completion, looked up
+by prefix without any API calls.
+
+Each project has a directory holding, for each kind of resource:
+
+* an index file of "<key>\\t<resource id>\\t<timestamp>" lines sorted by
+  key, binary searched for the first key matching a prefix, so lookups
+  only read a few pages whatever the number of resources;
+* a small journal of entries appended by regular list and get calls,
+  merged into the index once it grows past a size limit.
+
+Entries older than the cache's time to live are ignored and dropped when
+the index is rewritten.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import tempfile
+import time
+
+import six
+
+COMPLETION_CACHE_ENV = 'NOVAGUEST_COMPLETION_CACHE_DIR'
+
+KIND_INSTANCE = 'instance'
+KIND_EXPORT = 'export'
+KIND_IMPORT = 'import'
+
+# Client managers listed by a cache refresh, by resource kind
+REFRESHED_MANAGERS = {
+    KIND_INSTANCE: 'networking',
+}
+
+DEFAULT_TTL = 24 * 3600
+
+_INDEX_SUFFIX = '.idx'
+_JOURNAL_SUFFIX = '.journal'
+_LOCK_SUFFIX = '.lock'
+# Journals are merged into the index past this size in bytes, and bigger
+# batches of entries are merged directly
+_MAX_JOURNAL_SIZE = 1024 * 1024
+_MAX_JOURNAL_ENTRIES = 1000
+
+
+def get_default_dir(environ=None):
+    environ = os.environ if environ is None else environ
+    return environ.get(COMPLETION_CACHE_ENV) or os.path.join(
+        os.path.expanduser('~'), '.nova-guest', 'completion')
+
+
+def get_entries(resource):
+    """ Returns the (key, resource id) completion entries of a resource:
+    its ID and, if it has one, its human ID. """
+    info = resource._info
+    resource_id = info.get('instance_id') or info.get('id')
+    if not resource_id:
+        return []
+    entries = [(resource_id, resource_id)]
+    human_id = resource.human_id
+    if human_id:
+        entries.append((human_id, resource_id))
+    return entries
+
+
+def _to_line(key, resource_id, timestamp):
+    # NOTE: tabs and newlines would break the line format
+    key, resource_id = (
+        six.text_type(value).replace('\t', ' ').replace('\n', ' ')
+        for value in (key, resource_id))
+    return ('%s\t%s\t%.3f\n' % (key, resource_id, timestamp)).encode(
+        'utf-8')
+
+
+def _parse_line(line):
+    """ Returns the (key, resource id, timestamp) of a line, or None if it
+    is malformed, e.g. truncated by an interrupted write. """
+    fields = line.rstrip(b'\n').split(b'\t')
+    if len(fields) != 3:
+        return None
+    try:
+        return fields[0], fields[1], float(fields[2])
+    except ValueError:
+        return None
+
+
+def _iter_lines(path):
+    try:
+        with open(path, 'rb') as fin:
+            for line in fin:
+                yield line
+    except (IOError, OSError):
+        return
+
+
+def _find_first(mapped, prefix):
+    """ Returns the offset of the first line of a sorted index whose key is
+    greater than or equal to `prefix`. """
+    low, high = 0, len(mapped)
+    while low < high:
+        middle = (low + high) // 2
+        start = mapped.rfind(b'\n', 0, middle) + 1
+        end = mapped.find(b'\n', start)
+        if end == -1:
+            end = len(mapped)
+        key = mapped[start:end].split(b'\t', 1)[0]
+        if key < prefix:
+            low = end + 1
+        else:
+            high = start
+    return low
+
+
+class CompletionCache(object):
+    """ Per-project completion cache.
+
+    :param scope: value identifying the project, such as an (auth URL,
+        project) tuple, hashed to name its directory
+    :param path: base directory of the cache
+    :param ttl: seconds after which entries are ignored
+    """
+
+    def __init__(self, scope=None, path=None, ttl=DEFAULT_TTL):
+        scope_hash = hashlib.sha256(
+            json.dumps(scope, sort_keys=True).encode('utf-8')).hexdigest()
+        self.path = os.path.join(path or get_default_dir(), scope_hash[:32])
+        self.ttl = ttl
+
+    def _get_path(self, kind, suffix):
+        return os.path.join(self.path, kind + suffix)
+
+    def _ensure_dir(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+
+    def _is_fresh(self, timestamp, now):
+        return self.ttl is None or now - timestamp <= self.ttl
+
+    def add(self, kind, entries):
+        """ Adds (key, resource id) entries. Small batches are appended to
+        the journal, large ones merged into the index. """
+        now = time.time()
+        lines = [_to_line(key, resource_id, now)
+                 for (key, resource_id) in entries]
+        if not lines:
+            return
+        self._ensure_dir()
+        if len(lines) >= _MAX_JOURNAL_ENTRIES:
+            self.compact(kind, lines)
+            return
+
+        journal_path = self._get_path(kind, _JOURNAL_SUFFIX)
+        # NOTE: appends only exclude compactions, which could otherwise
+        # rename and merge the journal between its opening and the write
+        with self._lock(kind, fcntl.LOCK_SH):
+            fd = os.open(journal_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            try:
+                # NOTE: a single appending write, not interleaved with the
+                # ones of concurrent processes
+                os.write(fd, b''.join(lines))
+                journal_size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        if journal_size > _MAX_JOURNAL_SIZE:
+            self.compact(kind)
+
+    def add_resources(self, kind, resources):
+        self.add(kind, itertools.chain.from_iterable(
+            get_entries(resource) for resource in resources))
+
+    @contextlib.contextmanager
+    def _lock(self, kind, operation):
+        """ Holds the lock of a kind, shared by the journal appends and
+        exclusive for the index rewrites, by all the threads and processes,
+        which would otherwise drop each other's entries. """
+        fd = os.open(self._get_path(kind, _LOCK_SUFFIX),
+                     os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def compact(self, kind, lines=(), before=None):
+        """ Rewrites the index with the journal and the given lines merged
+        in, dropping the duplicate and expired entries, as well as the ones
+        last seen before the `before` timestamp, if given. """
+        self._ensure_dir()
+        with self._lock(kind, fcntl.LOCK_EX):
+            self._compact(kind, lines, before)
+
+    def _compact(self, kind, lines, before):
+        index_path = self._get_path(kind, _INDEX_SUFFIX)
+        journal_path = self._get_path(kind, _JOURNAL_SUFFIX)
+        # NOTE: entries appended while compacting go to a new journal
+        compacting_path = journal_path + '.compacting'
+        try:
+            os.rename(journal_path, compacting_path)
+        except OSError:
+            # NOTE: no journal, or left behind by an interrupted compaction
+            pass
+        new_lines = sorted(
+            itertools.chain(lines, _iter_lines(compacting_path)))
+
+        now = time.time()
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=kind + _INDEX_SUFFIX + '.', suffix='.tmp', dir=self.path)
+        try:
+            self._write_index(fd, index_path, new_lines, now, before)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        os.rename(tmp_path, index_path)
+        if os.path.exists(compacting_path):
+            os.unlink(compacting_path)
+
+    def _write_index(self, fd, index_path, new_lines, now, before):
+        with os.fdopen(fd, 'wb') as fout:
+            previous = None
+            # NOTE: lines sort by key, then resource id, then timestamp, so
+            # the last line of a duplicate run is the most recent one
+            for line in heapq.merge(_iter_lines(index_path), new_lines):
+                parsed = _parse_line(line)
+                if parsed is None:
+                    continue
+                key, resource_id, timestamp = parsed
+                if previous is not None and previous[:2] != (key,
+                                                             resource_id):
+                    fout.write(previous[3])
+                previous = None
+                if self._is_fresh(timestamp, now) and (
+                        before is None or timestamp >= before):
+                    previous = (key, resource_id, timestamp, line)
+            if previous is not None:
+                fout.write(previous[3])
+
+    def lookup(self, kind, prefix='', limit=None):
+        """ Returns the sorted keys starting with `prefix`. """
+        prefix_bytes = six.text_type(prefix).encode('utf-8')
+        now = time.time()
+        keys = set()
+
+        for line in _iter_lines(self._get_path(kind, _JOURNAL_SUFFIX)):
+            parsed = _parse_line(line)
+            if parsed is None:
+                continue
+            key, _, timestamp = parsed
+            if key.startswith(prefix_bytes) and self._is_fresh(timestamp,
+                                                               now):
+                keys.add(key)
+
+        index_path = self._get_path(kind, _INDEX_SUFFIX)
+        if os.path.exists(index_path) and os.path.getsize(index_path):
+            with open(index_path, 'rb') as fin:
+                mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    mapped.seek(_find_first(mapped, prefix_bytes))
+                    for line in iter(mapped.readline, b''):
+                        parsed = _parse_line(line)
+                        if parsed is None:
+                            continue
+                        key, _, timestamp = parsed
+                        if not key.startswith(prefix_bytes):
+                            break
+                        if self._is_fresh(timestamp, now):
+                            keys.add(key)
+                            if limit is not None and len(keys) >= limit:
+                                break
+                finally:
+                    mapped.close()
+
+        keys = sorted(key.decode('utf-8') for key in keys)
+        return keys[:limit] if limit is not None else keys
+
+    def refresh(self, guest_client):
+        """ Lists the resources of all the refreshed managers of the given
+        client into the cache, dropping the entries of resources which no
+        longer exist.
+
+        :returns: dict with the number of resources listed for each kind
+        """
+        counts = {}
+        for kind, manager_name in REFRESHED_MANAGERS.items():
+            # NOTE: rounded down to the precision of the entries' timestamps
+            started_at = math.floor(time.time() * 1000) / 1000
+            resources = getattr(guest_client, manager_name).list()
+            # NOTE: list calls add the entries to the client's own cache,
+            # which may be another instance for the same directory
+            client_cache = getattr(guest_client.http_client,
+                                   'completion_cache', None)
+            if client_cache is None or client_cache.path != self.path:
+                self.add_resources(kind, resources)
+            self.compact(kind, before=started_at)
+            counts[kind] = len(resources)
+        return counts
+
+    def clear(self, kind):
+        for suffix in (_INDEX_SUFFIX, _JOURNAL_SUFFIX):
+            path = self._get_path(kind, suffix)
+            if os.path.exists(path):
+                os.unlink(path)
@@ -47,4 +47,8 @@ OS_LIST = [
     OS_TYPE_WINDOWS,
     OS_TYPE_OTHER,
     OS_TYPE_UNKNOWN,
-]
\ No newline at end of file
+]
+
+API_CAPABILITY_BATCH_ACTIONS = "batch-actions"
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
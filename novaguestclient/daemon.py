@@ -0,0 +1,249 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local Unix socket daemon keeping authenticated clients warm between CLI
+invocations, together with the thin client used to talk to it.
+
+The wire protocol is a single length-prefixed JSON request followed by a
+single length-prefixed JSON response per connection.
+"""
+
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import threading
+
+from six.moves import socketserver
+
+from novaguestclient import exceptions
+
+LOG = logging.getLogger(__name__)
+
+DAEMON_SOCKET_ENV = 'NOVAGUEST_DAEMON_SOCKET'
+DAEMON_SOCKET_OPTION = '--daemon-socket'
+
+# Only the environment variables which influence the CLI are forwarded
+_FORWARDED_ENV_PREFIXES = ('OS_', 'NOVAGUESTAGENT_', 'NOVAGUEST_')
+
+_HEADER = struct.Struct('!I')
+_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+def get_default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(os.path.expanduser('~'), '.nova-guest')
+    return os.path.join(runtime_dir, 'nova-guest.sock')
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise exceptions.DaemonProtocolError(
+                "Connection closed before the message was complete")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > _MAX_MESSAGE_SIZE:
+        raise exceptions.DaemonProtocolError(
+            "Message of %d bytes exceeds the maximum size" % size)
+    return json.loads(_recv_exactly(sock, size).decode('utf-8'))
+
+
+def _get_peer_uid(sock):
+    """ Returns the uid of the process on the other end of the socket, or
+    None if the platform does not support SO_PEERCRED """
+    peercred = getattr(socket, 'SO_PEERCRED', None)
+    if peercred is None:
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, peercred, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid
+
+
+def pop_socket_path_from_argv(argv, environ=None):
+    """ Returns the daemon socket path requested either with the global
+    '--daemon-socket' option or the environment, along with the remaining
+    arguments which are to be forwarded to the daemon.
+    """
+    environ = os.environ if environ is None else environ
+    socket_path = environ.get(DAEMON_SOCKET_ENV)
+    remaining = []
+    args = iter(argv)
+    for arg in args:
+        if arg == DAEMON_SOCKET_OPTION:
+            socket_path = next(args, None)
+        elif arg.startswith(DAEMON_SOCKET_OPTION + '='):
+            socket_path = arg.split('=', 1)[1]
+        else:
+            remaining.append(arg)
+    return socket_path, remaining
+
+
+def forward_command(socket_path, argv, stdout, stderr, environ=None):
+    """ Runs the command given by `argv` on the daemon listening on
+    `socket_path`, writes its output to the given streams and returns the
+    command's exit status, or None if the daemon does not run this command
+    and it must be run locally instead, e.g. the interactive mode. Relative
+    paths given to the command are resolved against the current working
+    directory, which is forwarded as well.
+    """
+    environ = os.environ if environ is None else environ
+    env = dict((k, v) for (k, v) in environ.items()
+               if k.startswith(_FORWARDED_ENV_PREFIXES))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error as ex:
+            raise exceptions.DaemonNotRunning(socket_path, ex)
+        send_message(sock, {'argv': list(argv), 'env': env,
+                            'cwd': os.getcwd()})
+        response = recv_message(sock)
+    finally:
+        sock.close()
+
+    if response.get('run_locally'):
+        return None
+    stdout.write(response.get('stdout', ''))
+    stderr.write(response.get('stderr', ''))
+    return response.get('status', 1)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        peer_uid = _get_peer_uid(self.request)
+        if peer_uid is not None and peer_uid != os.getuid():
+            LOG.warning("Rejecting daemon connection from uid %s", peer_uid)
+            return
+
+        try:
+            request = recv_message(self.request)
+        except (exceptions.DaemonProtocolError, ValueError) as ex:
+            LOG.warning("Invalid daemon request: %s", ex)
+            return
+
+        try:
+            result = self.server.run_command(
+                request.get('argv', []), request.get('env', {}),
+                request.get('cwd'))
+        except Exception as ex:
+            LOG.exception("Daemon command failed")
+            result = 1, '', '%s\n' % ex
+        if result is None:
+            send_message(self.request, {'run_locally': True})
+            return
+        status, out, err = result
+        send_message(
+            self.request, {'status': status, 'stdout': out, 'stderr': err})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, run_command):
+        self.run_command = run_command
+        socketserver.UnixStreamServer.__init__(
+            self, socket_path, _RequestHandler)
+
+
+class Daemon(object):
+    """ Serves CLI commands over a Unix socket readable only by the owner.
+
+    :param socket_path: path of the socket to listen on
+    :param run_command: callable receiving the argv list, the forwarded
+        environment dict and the caller's working directory and returning a
+        (status, stdout, stderr) tuple, or None for the commands which must
+        be run by the caller itself
+    """
+
+    def __init__(self, socket_path, run_command):
+        self.socket_path = socket_path
+        self._run_command = run_command
+        self._server = None
+        self._lock = threading.Lock()
+
+    def _prepare_socket_path(self):
+        socket_dir = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+
+        try:
+            mode = os.lstat(self.socket_path).st_mode
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+
+        if not stat.S_ISSOCK(mode):
+            raise exceptions.NovaGuestAgentException(
+                "Refusing to replace non-socket file '%s'" % self.socket_path)
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except socket.error:
+            # NOTE: stale socket left behind by a daemon which is gone
+            os.unlink(self.socket_path)
+        else:
+            raise exceptions.NovaGuestAgentException(
+                "A daemon is already listening on '%s'" % self.socket_path)
+        finally:
+            probe.close()
+
+    def serve_forever(self):
+        self._prepare_socket_path()
+        old_umask = os.umask(0o077)
+        try:
+            server = _UnixServer(self.socket_path, self._run_command)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+
+        with self._lock:
+            self._server = server
+        LOG.info("nova-guest daemon listening on %s", self.socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            server = self._server
+        if server is not None:
+            server.shutdown()
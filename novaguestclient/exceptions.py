@@ -77,3 +77,44 @@ class LoggingEndpointNotFound(NovaGuestAgentException):
     def __init__(self, *args, **kw):
         super(EndpointIDNotFound, self).__init__(
             "no logging endpoint found in service catalogue")
+
+
+class DaemonNotRunning(NovaGuestAgentException):
+    """Raised when no nova-guest daemon is listening on the given socket"""
+
+    def __init__(self, socket_path, reason):
+        super(DaemonNotRunning, self).__init__(
+            "Could not connect to the nova-guest daemon on '%s': %s" % (
+                socket_path, reason))
+
+
+class DaemonProtocolError(NovaGuestAgentException):
+    """Raised for malformed messages exchanged with the nova-guest daemon"""
+    pass
+
+
+class DeadlineExceeded(NovaGuestAgentException):
+    """Raised when a call did not complete before its deadline"""
+
+    def __init__(self, *args, **kw):
+        super(DeadlineExceeded, self).__init__(
+            "The request did not complete before its deadline")
+
+
+class ExportDownloadError(NovaGuestAgentException):
+    """Raised when the data of an export could not be downloaded"""
+    pass
+
+
+class ImportUploadError(NovaGuestAgentException):
+    """Raised when the image of an import could not be uploaded"""
+    pass
+
+
+class ChecksumMismatch(NovaGuestAgentException):
+    """Raised when a transferred chunk does not match its checksum"""
+
+    def __init__(self, index, expected, actual):
+        super(ChecksumMismatch, self).__init__(
+            "Checksum mismatch for chunk %d: expected %s, got %s" % (
+                index, expected, actual))
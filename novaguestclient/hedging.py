@@ -0,0 +1,193 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-call deadlines and hedged requests for idempotent reads.
+"""
+
+import collections
+import threading
+import time
+
+from concurrent import futures
+
+from novaguestclient import exceptions
+from novaguestclient import profiling
+from novaguestclient import tracing
+
+
+def get_deadline(timeout, deadline=None):
+    """ Returns the earliest of the given absolute `deadline` and the one
+    resulting from a relative `timeout` in seconds, if any. """
+    if timeout is None:
+        return deadline
+    timeout_deadline = time.time() + timeout
+    if deadline is None:
+        return timeout_deadline
+    return min(deadline, timeout_deadline)
+
+
+def get_remaining_time(deadline):
+    """ Returns the seconds left until `deadline`, raising DeadlineExceeded
+    if it already passed. """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise exceptions.DeadlineExceeded()
+    return remaining
+
+
+class LatencyWindow(object):
+    """ Keeps the latencies of the most recent successful requests. """
+
+    def __init__(self, size=256, min_samples=20):
+        self._samples = collections.deque(maxlen=size)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def get_percentile(self, percentile):
+        """ Returns the given percentile of the recent latencies, or None if
+        there are not enough samples yet. """
+        with self._lock:
+            if len(self._samples) < self._min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class Hedger(object):
+    """ Sends a second copy of a request which did not complete within the
+    given percentile of the recent latencies and returns whichever copy
+    answers first.
+
+    :param percentile: latency percentile after which the request is hedged
+    :param max_extra_ratio: maximum ratio of hedged requests to requests,
+        capping the extra load hedging adds to the server
+    :param max_workers: size of the thread pool sending the requests which
+        may be hedged. Requests are sent from the caller's thread when they
+        can not be hedged, or when all the workers are busy.
+    """
+
+    def __init__(self, percentile=95, max_extra_ratio=0.1, max_workers=16,
+                 window=None):
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.window = window or LatencyWindow()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._free_workers = threading.Semaphore(max_workers)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+
+    def _timed(self, fn):
+        start = time.time()
+        result = fn()
+        self.window.add(time.time() - start)
+        return result
+
+    def _can_hedge(self):
+        return self._hedged + 1 <= self._requests * self.max_extra_ratio
+
+    def _acquire_hedge(self):
+        with self._lock:
+            if not self._can_hedge():
+                return False
+            self._hedged += 1
+            return True
+
+    def _submit(self, fn):
+        """ Sends the request from a free worker, returning None instead
+        of queueing it if there is none. """
+        if not self._free_workers.acquire(False):
+            return None
+        future = self._executor.submit(
+            self._timed, profiling.wrap(tracing.wrap(fn)))
+        future.add_done_callback(lambda _: self._free_workers.release())
+        return future
+
+    def _wait(self, pending, deadline, return_when):
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+        done, pending = futures.wait(
+            pending, timeout=timeout, return_when=return_when)
+        if not done and pending and deadline is not None:
+            raise exceptions.DeadlineExceeded()
+        return done, pending
+
+    def call(self, fn, deadline=None):
+        """ Calls `fn`, hedging it if it is slower than usual.
+
+        :param fn: callable without arguments sending the request
+        :param deadline: absolute time after which DeadlineExceeded is
+            raised, even if the requests are still running
+        """
+        with self._lock:
+            self._requests += 1
+            can_hedge = self._can_hedge()
+
+        delay = self.window.get_percentile(self.percentile)
+        # NOTE: a request sent from the caller's thread can not be abandoned
+        # for a faster hedge, so only the ones which may be hedged are sent
+        # from the pool
+        primary = None
+        if delay is not None and can_hedge:
+            primary = self._submit(fn)
+        if primary is None:
+            return self._timed(fn)
+
+        hedge_deadline = time.time() + delay
+        if deadline is not None:
+            hedge_deadline = min(hedge_deadline, deadline)
+        done, pending = futures.wait([primary], timeout=max(
+            hedge_deadline - time.time(), 0))
+        hedge = None
+        if not done and self._acquire_hedge():
+            hedge = self._submit(fn)
+            if hedge is None:
+                with self._lock:
+                    self._hedged -= 1
+        if hedge is None:
+            self._wait([primary], deadline, futures.ALL_COMPLETED)
+            return primary.result()
+
+        pending = set([primary, hedge])
+        while pending:
+            done, pending = self._wait(
+                pending, deadline, futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return future.result()
+        # NOTE: both copies failed, report the original request's error
+        return primary.result()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'hedged': self._hedged,
+                'hedge_wins': self._hedge_wins,
+                'hedge_delay': self.window.get_percentile(self.percentile),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
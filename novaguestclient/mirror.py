@@ -0,0 +1,277 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local SQLite mirror of the results reported by the guest agents, kept up
+to date incrementally and queried without any API calls.
+
+The same database holds the ledger of the last action successfully applied
+by this client on each resource, along with the fingerprint of the
+configuration it applied.
+"""
+
+import calendar
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+from oslo_utils import timeutils
+import six
+
+MIRROR_DB_ENV = 'NOVAGUEST_MIRROR_DB'
+
+KIND_NETWORKING = 'networking'
+
+# Client managers mirrored by sync_client(), by result kind
+SYNCED_MANAGERS = {
+    KIND_NETWORKING: 'networking',
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    kind TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    success INTEGER,
+    message TEXT,
+    updated_at REAL NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (kind, region, resource_id)
+);
+CREATE INDEX IF NOT EXISTS results_success_updated_at
+    ON results (kind, success, updated_at);
+CREATE INDEX IF NOT EXISTS results_region_updated_at
+    ON results (kind, region, success, updated_at);
+CREATE TABLE IF NOT EXISTS applied (
+    kind TEXT NOT NULL,
+    region TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    fingerprint TEXT,
+    idempotency_key TEXT,
+    applied_at REAL NOT NULL,
+    PRIMARY KEY (kind, region, resource_id)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    kind TEXT NOT NULL,
+    region TEXT NOT NULL,
+    watermark REAL NOT NULL,
+    PRIMARY KEY (kind, region)
+);
+"""
+
+_UPSERT = """
+INSERT OR REPLACE INTO results
+    (kind, region, resource_id, success, message, updated_at, synced_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_UPSERT_APPLIED = """
+INSERT OR REPLACE INTO applied
+    (kind, region, resource_id, fingerprint, idempotency_key, applied_at)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# NOTE: below SQLite's default limit of 999 variables per statement
+_MAX_QUERY_IDS = 500
+
+_COLUMNS = ('kind', 'region', 'resource_id', 'success', 'message',
+            'updated_at', 'synced_at')
+
+
+def get_default_path(environ=None):
+    environ = os.environ if environ is None else environ
+    return environ.get(MIRROR_DB_ENV) or os.path.join(
+        os.path.expanduser('~'), '.nova-guest', 'mirror.sqlite')
+
+
+def to_timestamp(value):
+    """ Converts an ISO 8601 string, datetime or number to a UNIX
+    timestamp. """
+    if value is None:
+        return None
+    if isinstance(value, six.string_types):
+        value = timeutils.parse_isotime(value)
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(
+            timeutils.normalize_time(value).timetuple()) + (
+                value.microsecond / 1e6)
+    return float(value)
+
+
+def _to_db_bool(value):
+    return None if value is None else int(bool(value))
+
+
+def to_isotime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class Mirror(object):
+    """ SQLite mirror of per-resource results.
+
+    :param path: path of the database file, created if missing
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_default_path()
+        db_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir, 0o700)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def record_many(self, kind, rows, region=''):
+        """ Stores results given as (resource_id, success, message,
+        updated_at) tuples, replacing the previous ones. """
+        synced_at = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(_UPSERT, (
+                (kind, region, resource_id, _to_db_bool(success), message,
+                 to_timestamp(updated_at) or synced_at, synced_at)
+                for (resource_id, success, message, updated_at) in rows))
+
+    def record(self, kind, resource_id, success, message, region='',
+               updated_at=None):
+        self.record_many(
+            kind, [(resource_id, success, message, updated_at)], region)
+
+    def record_applied_many(self, kind, rows, region=''):
+        """ Records successfully applied actions given as (resource_id,
+        fingerprint, idempotency_key) tuples, replacing the previous
+        ones. """
+        applied_at = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(_UPSERT_APPLIED, (
+                (kind, region, resource_id, fingerprint, idempotency_key,
+                 applied_at)
+                for (resource_id, fingerprint, idempotency_key) in rows))
+
+    def record_applied(self, kind, resource_id, fingerprint=None,
+                       idempotency_key=None, region=''):
+        self.record_applied_many(
+            kind, [(resource_id, fingerprint, idempotency_key)], region)
+
+    def get_applied_fingerprints(self, kind, resource_ids, region=''):
+        """ Returns a dict with the fingerprint of the last action applied
+        on each of the given resources, for those which have one. """
+        resource_ids = list(resource_ids)
+        fingerprints = {}
+        with self._lock:
+            for start in range(0, len(resource_ids), _MAX_QUERY_IDS):
+                block = resource_ids[start:start + _MAX_QUERY_IDS]
+                rows = self._conn.execute(
+                    "SELECT resource_id, fingerprint FROM applied "
+                    "WHERE kind = ? AND region = ? AND fingerprint IS NOT "
+                    "NULL AND resource_id IN (%s)" % ', '.join(
+                        '?' * len(block)), [kind, region] + block)
+                fingerprints.update(rows)
+        return fingerprints
+
+    def get_watermark(self, kind, region=''):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT watermark FROM watermarks "
+                "WHERE kind = ? AND region = ?", (kind, region)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, kind, region, watermark):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO watermarks (kind, region, watermark) "
+            "VALUES (?, ?, ?)", (kind, region, watermark))
+
+    def sync(self, manager, kind, region=''):
+        """ Fetches the results updated since the last sync from the given
+        manager's list(updated_since=...) method and stores them.
+
+        Only the update times given by the server move the watermark, as
+        the local clock may be ahead of the server's: results without one
+        are stored as updated when synced, and fetched again next time.
+
+        :returns: the number of results fetched
+        """
+        watermark = self.get_watermark(kind, region)
+        since = to_isotime(watermark) if watermark is not None else None
+        resources = manager.list(updated_since=since)
+
+        synced_at = time.time()
+        rows = []
+        for resource in resources:
+            updated_at = to_timestamp(getattr(resource, 'updated_at', None))
+            rows.append((
+                kind, region,
+                getattr(resource, 'instance_id', None) or resource.id,
+                _to_db_bool(getattr(resource, 'success', None)),
+                getattr(resource, 'message', None),
+                updated_at or synced_at, synced_at))
+            if updated_at:
+                watermark = max(watermark or updated_at, updated_at)
+
+        with self._lock, self._conn:
+            self._conn.executemany(_UPSERT, rows)
+            if watermark is not None:
+                self._set_watermark(kind, region, watermark)
+        return len(rows)
+
+    def sync_client(self, guest_client, region=''):
+        """ Syncs all the mirrored managers of the given client.
+
+        :returns: dict with the number of results fetched for each kind
+        """
+        return dict(
+            (kind, self.sync(getattr(guest_client, manager_name), kind,
+                             region))
+            for kind, manager_name in SYNCED_MANAGERS.items())
+
+    def query(self, kind=KIND_NETWORKING, success=None, region=None,
+              since=None, until=None, limit=None):
+        """ Returns the stored results as dicts, most recent first.
+
+        :param success: only return successful (True) or failed (False)
+            results
+        :param since: only return results updated at or after this time,
+            given as a timestamp, datetime or ISO 8601 string
+        :param until: only return results updated before this time
+        """
+        conditions = ['kind = ?']
+        params = [kind]
+        if success is not None:
+            conditions.append('success = ?')
+            params.append(_to_db_bool(success))
+        if region is not None:
+            conditions.append('region = ?')
+            params.append(region)
+        if since is not None:
+            conditions.append('updated_at >= ?')
+            params.append(to_timestamp(since))
+        if until is not None:
+            conditions.append('updated_at < ?')
+            params.append(to_timestamp(until))
+
+        sql = "SELECT %s FROM results WHERE %s ORDER BY updated_at DESC" % (
+            ', '.join(_COLUMNS), ' AND '.join(conditions))
+        if limit is not None:
+            sql += " LIMIT %d" % int(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
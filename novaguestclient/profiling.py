@@ -0,0 +1,208 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+CPU and memory profiling of a single command run, with phase markers
+attributing time to authentication, catalog lookup, HTTP and formatting.
+
+The running profiler is tracked per thread, so that the phases of the other
+commands run concurrently by the daemon are not attributed to it. Functions
+run from other threads on behalf of a profiled one must be wrapped with
+wrap(). cProfile and tracemalloc being process-wide, profiled commands run
+one at a time.
+"""
+
+import cProfile
+import functools
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # NOTE: tracemalloc is only available starting with Python 3.4
+    tracemalloc = None
+
+from novaguestclient import exceptions
+
+PHASE_AUTH = 'auth'
+PHASE_CATALOG = 'catalog'
+PHASE_HTTP = 'http'
+PHASE_FORMATTING = 'formatting'
+# Phases which happen before the profiler starts, measured separately
+PHASE_IMPORTS = 'imports'
+PHASE_PLUGINS = 'plugins'
+
+_local = threading.local()
+_exclusive = threading.Lock()
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def is_active():
+    return getattr(_local, 'profiler', None) is not None
+
+
+def phase(name):
+    """ Returns a context manager attributing the enclosed block to the
+    given phase of the profiler running in this thread, doing nothing if
+    there is none. """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return _NULL_PHASE
+    return profiler.phase(name)
+
+
+def wrap(fn):
+    """ Returns `fn` wrapped to attribute its phases to the profiler running
+    in the calling thread, whichever thread runs it. Returns `fn` itself if
+    there is none. """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return fn
+
+    @functools.wraps(fn)
+    def _wrapped(*args, **kwargs):
+        previous = getattr(_local, 'profiler', None)
+        _local.profiler = profiler
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.profiler = previous
+    return _wrapped
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+        self._start_memory = self._profiler.get_traced_memory()
+        return self
+
+    def __exit__(self, *exc_info):
+        memory = self._profiler.get_traced_memory()
+        self._profiler.add_phase(
+            self._name, time.time() - self._start,
+            memory - self._start_memory if memory is not None else None)
+        return False
+
+
+class Profiler(object):
+    """ Collects a cProfile profile and/or a tracemalloc snapshot between
+    start() and stop().
+
+    :param profile_file: path where the cProfile stats are written
+    :param trace_malloc_file: path where the top allocation sites are
+        written
+    :param top: number of allocation sites to report
+    """
+
+    def __init__(self, profile_file=None, trace_malloc_file=None, top=25):
+        if trace_malloc_file and tracemalloc is None:
+            raise exceptions.NovaGuestAgentException(
+                "Memory tracing requires Python 3.4 or newer")
+        self.profile_file = profile_file
+        self.trace_malloc_file = trace_malloc_file
+        self.top = top
+        self._profile = None
+        self._phases = {}
+        self._lock = threading.Lock()
+        self._start = None
+        self.elapsed = None
+
+    def get_traced_memory(self):
+        if not self.trace_malloc_file:
+            return None
+        return tracemalloc.get_traced_memory()[0]
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add_phase(self, name, elapsed, memory_delta):
+        with self._lock:
+            calls, total, memory = self._phases.get(name, (0, 0.0, 0))
+            self._phases[name] = (
+                calls + 1, total + elapsed, memory + (memory_delta or 0))
+
+    def get_phases(self):
+        """ Returns a dict mapping the phase names to their number of calls,
+        total seconds and net allocated bytes (when tracing memory). """
+        with self._lock:
+            return dict(self._phases)
+
+    def start(self):
+        """ Starts profiling the calling thread, waiting for the profiled
+        commands of other threads to complete first. """
+        _exclusive.acquire()
+        try:
+            if self.trace_malloc_file:
+                tracemalloc.start()
+            if self.profile_file:
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+        except Exception:
+            _exclusive.release()
+            raise
+        self._start = time.time()
+        _local.profiler = self
+
+    def stop(self):
+        """ Stops profiling, from the thread which started it. """
+        _local.profiler = None
+        self.elapsed = time.time() - self._start
+        try:
+            if self._profile is not None:
+                self._profile.disable()
+                self._profile.dump_stats(self.profile_file)
+            if self.trace_malloc_file:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self._write_snapshot(snapshot, current, peak)
+        finally:
+            _exclusive.release()
+
+    def _write_snapshot(self, snapshot, current, peak):
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        with open(self.trace_malloc_file, 'w') as fout:
+            fout.write("Traced memory: current %d bytes, peak %d bytes\n" % (
+                current, peak))
+            fout.write("Top %d allocation sites:\n" % self.top)
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                fout.write("%s\n" % stat)
+
+    def format_report(self):
+        lines = ["Command ran in %.3fs" % self.elapsed]
+        for name, (calls, total, memory) in sorted(self.get_phases().items()):
+            line = "  %-12s %8.3fs in %d call(s)" % (name, total, calls)
+            if self.trace_malloc_file:
+                line += ", %+d bytes" % memory
+            lines.append(line)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+
+import six
+
+from novaguestclient import exceptions
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """ Collapses concurrent calls sharing the same key into a single
+    execution whose result (or exception) is handed to all the callers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """ Calls fn(*args, **kwargs), or waits for the in-flight call with
+        the same key.
+
+        :param deadline: keyword argument, not passed to `fn`, with the
+            absolute time after which waiting for an in-flight call fails
+            with DeadlineExceeded
+        """
+        deadline = kwargs.pop('deadline', None)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._executed += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            if not call.done.wait(timeout):
+                raise exceptions.DeadlineExceeded()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def get_stats(self):
+        """ Returns the number of calls made, how many of them were actually
+        executed and how many were served by an already in-flight call. """
+        with self._lock:
+            return {
+                'calls': self._executed + self._coalesced,
+                'executed': self._executed,
+                'coalesced': self._coalesced,
+            }
@@ -0,0 +1,150 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from novaguestclient.cli import utils
+
+
+def _iter_items(text, read_size):
+    return list(utils._iter_array_items(
+        utils._JSONStreamReader(io.StringIO(text), read_size=read_size)))
+
+
+class JSONStreamReaderTest(unittest.TestCase):
+
+    def _assert_items(self, items, text=None):
+        text = json.dumps(items) if text is None else text
+        # NOTE: tiny buffers cut the values at every possible position
+        for read_size in (1, 2, 3, 7, 64 * 1024):
+            self.assertEqual(items, _iter_items(text, read_size))
+
+    def test_empty_array(self):
+        self._assert_items([])
+        self._assert_items([], ' [ \n ] \n')
+
+    def test_values(self):
+        self._assert_items([
+            1, -2, 1.5e3, 0.25, True, False, None, 'text',
+            'escaped "quotes" \\ \t \n', {'a': [1, {'b': None}]}, [],
+            {}])
+
+    def test_numbers_cut_by_buffer(self):
+        self._assert_items([1.5e3, 123456789, -0.5], '[1.5e3,123456789,-0.5]')
+
+    def test_whitespace(self):
+        self._assert_items([1, 'a'], '\n\t[ 1 ,\n  "a"\n]\n')
+
+    def _assert_error(self, text, message, read_size=2):
+        with self.assertRaises(ValueError) as cm:
+            _iter_items(text, read_size)
+        self.assertIn(message, str(cm.exception))
+        return str(cm.exception)
+
+    def test_not_an_array(self):
+        self._assert_error('{"a": 1}', "Expecting '['")
+
+    def test_missing_delimiter(self):
+        self._assert_error('[1 2]', "Expecting ',' or ']'")
+
+    def test_unterminated(self):
+        self._assert_error('[1, 2', "Expecting ',' or ']'")
+        self._assert_error('["abc', 'Unterminated string')
+
+    def test_extra_data(self):
+        self._assert_error('[1] 2', 'Extra data')
+
+    def test_invalid_value(self):
+        self._assert_error('[1, nope]', 'Expecting value')
+
+    def test_error_location(self):
+        message = self._assert_error('[\n  1,\n  x]', 'Expecting value')
+        self.assertIn('line 3 column 3 (char 9)', message)
+
+
+class IterOptionItemsFromArgsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.parser = argparse.ArgumentParser()
+        utils.add_args_for_json_option_to_parser(
+            self.parser, 'instance_ids', cwd=self.tmp_dir)
+
+    def _write(self, text):
+        with open(os.path.join(self.tmp_dir, 'ids.json'), 'w') as fout:
+            fout.write(text)
+        return 'ids.json'
+
+    def _iter(self, argv, **kwargs):
+        args = self.parser.parse_args(argv)
+        return list(utils.iter_option_items_from_args(
+            args, 'instance_ids', **kwargs))
+
+    def test_inline(self):
+        self.assertEqual(['a', 'b'],
+                         self._iter(['--instance-ids', '["a", "b"]']))
+
+    def test_file(self):
+        path = self._write('["a", "b"]')
+        self.assertEqual(['a', 'b'],
+                         self._iter(['--instance-ids-file', path]))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError) as cm:
+            self._iter(['--instance-ids', '{"a": 1}'])
+        self.assertIn('must be an array', str(cm.exception))
+
+    def test_file_parse_error(self):
+        path = self._write('["a", "b" "c"]')
+        items = []
+        with self.assertRaises(ValueError) as cm:
+            for item in utils.iter_option_items_from_args(
+                    self.parser.parse_args(['--instance-ids-file', path]),
+                    'instance_ids'):
+                items.append(item)
+        self.assertEqual(['a', 'b'], items)
+        self.assertIn('after 2 item(s)', str(cm.exception))
+
+    def test_no_value(self):
+        with self.assertRaises(ValueError) as cm:
+            self._iter([])
+        self.assertIn('No \'--instance-ids[-file]\' parameter',
+                      str(cm.exception))
+        self.assertEqual([], self._iter([], error_on_no_value=False))
+
+    def test_empty_array(self):
+        with self.assertRaises(ValueError) as cm:
+            self._iter(['--instance-ids', '[]'])
+        self.assertIn('array is empty', str(cm.exception))
+        self.assertEqual(
+            [], self._iter(['--instance-ids', '[]'],
+                           error_on_no_value=False))
+
+    def test_empty_array_file(self):
+        path = self._write('[]')
+        with self.assertRaises(ValueError) as cm:
+            self._iter(['--instance-ids-file', path])
+        self.assertIn("array from '%s' is empty" % os.path.join(
+            self.tmp_dir, path), str(cm.exception))
+        self.assertEqual(
+            [], self._iter(['--instance-ids-file', path],
+                           error_on_no_value=False))
@@ -0,0 +1,243 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+import unittest
+
+from novaguestclient import bulk
+
+
+class _Recorder(object):
+    """ Bulk function recording the order in which items start and the
+    peak number of concurrent calls, overall and per group. """
+
+    def __init__(self, group_key=None, duration=0.0):
+        self.group_key = group_key
+        self.duration = duration
+        self.started = []
+        self.peak = 0
+        self.group_peaks = collections.Counter()
+        self._running = 0
+        self._group_running = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, item):
+        group = self.group_key(item) if self.group_key else None
+        with self._lock:
+            self.started.append(item)
+            self._running += 1
+            self._group_running[group] += 1
+            self.peak = max(self.peak, self._running)
+            self.group_peaks[group] = max(self.group_peaks[group],
+                                          self._group_running[group])
+        time.sleep(self.duration)
+        with self._lock:
+            self._running -= 1
+            self._group_running[group] -= 1
+        return item
+
+
+def _group(item):
+    return item[0]
+
+
+class RunTest(unittest.TestCase):
+
+    def test_results(self):
+        results = {}
+
+        def callback(index, item, result, exc, latency):
+            results[index] = (item, result, exc)
+
+        bulk.run(lambda item: item * 2, iter(range(50)), concurrency=4,
+                 callback=callback)
+        self.assertEqual(
+            dict((i, (i, i * 2, None)) for i in range(50)), results)
+
+    def test_exceptions_passed_to_callback(self):
+        errors = []
+
+        def fn(item):
+            raise RuntimeError(item)
+
+        bulk.run(fn, range(3), callback=lambda index, item, result, exc,
+                 latency: errors.append(str(exc)))
+        self.assertEqual(['0', '1', '2'], sorted(errors))
+
+    def test_fifo_order(self):
+        recorder = _Recorder()
+        bulk.run(recorder, range(20), concurrency=1)
+        self.assertEqual(list(range(20)), recorder.started)
+
+    def test_fifo_order_across_groups(self):
+        items = ['a1', 'b1', 'a2', 'c1', 'b2', 'a3']
+        recorder = _Recorder(_group)
+        bulk.run(recorder, items, concurrency=1, group_key=_group)
+        self.assertEqual(items, recorder.started)
+
+    def test_shortest_first_order(self):
+        items = ['s1', 'f1', 's2', 'f2', 's3', 'f3']
+        recorder = _Recorder(_group)
+        bulk.run(recorder, items, concurrency=1, group_key=_group,
+                 order=bulk.ORDER_SHORTEST_FIRST,
+                 expected_durations={'s': 10.0, 'f': 1.0})
+        self.assertEqual(['f1', 'f2', 'f3', 's1', 's2', 's3'],
+                         recorder.started)
+
+    def test_longest_first_order(self):
+        items = ['s1', 'f1', 's2', 'f2']
+        recorder = _Recorder(_group)
+        bulk.run(recorder, items, concurrency=1, group_key=_group,
+                 order=bulk.ORDER_LONGEST_FIRST,
+                 expected_durations={'s': 10.0, 'f': 1.0})
+        self.assertEqual(['s1', 's2', 'f1', 'f2'], recorder.started)
+
+    def test_unknown_durations_first(self):
+        items = ['f1', 'u1', 'f2']
+        recorder = _Recorder(_group)
+        bulk.run(recorder, items, concurrency=1, group_key=_group,
+                 order=bulk.ORDER_SHORTEST_FIRST,
+                 expected_durations={'f': 1.0})
+        self.assertEqual('u1', recorder.started[0])
+
+    def test_concurrency(self):
+        recorder = _Recorder(duration=0.01)
+        bulk.run(recorder, range(40), concurrency=4)
+        self.assertEqual(4, recorder.peak)
+
+    def test_group_concurrency(self):
+        items = ['%s%d' % (group, i) for i in range(10) for group in 'ab']
+        recorder = _Recorder(_group, duration=0.01)
+        stats = bulk.run(recorder, items, concurrency=4, group_key=_group,
+                         group_concurrency={'a': 1})
+        self.assertEqual(1, recorder.group_peaks['a'])
+        self.assertEqual(3, recorder.group_peaks['b'])
+        self.assertEqual(1, stats['a']['concurrency'])
+        self.assertEqual(4, stats['b']['concurrency'])
+        self.assertEqual(10, stats['a']['calls'])
+        self.assertEqual(10, stats['b']['calls'])
+
+    def test_blocked_group_does_not_hold_back_others(self):
+        # NOTE: a lookahead full of items of a group at its limit
+        items = ['a%d' % i for i in range(5)] + ['b0']
+        recorder = _Recorder(_group, duration=0.02)
+        bulk.run(recorder, items, concurrency=2, group_key=_group,
+                 group_concurrency={'a': 1}, lookahead=2)
+        self.assertLess(recorder.started.index('b0'),
+                        recorder.started.index('a4'))
+
+    def test_lookahead_bounds_buffered_items(self):
+        read = []
+        lock = threading.Lock()
+        peak = [0]
+
+        def items():
+            for i in range(200):
+                read.append(i)
+                yield i
+
+        done = []
+
+        def fn(item):
+            with lock:
+                peak[0] = max(peak[0], len(read) - len(done))
+            time.sleep(0.001)
+            with lock:
+                done.append(item)
+
+        bulk.run(fn, items(), concurrency=2, lookahead=5)
+        # NOTE: the running items, plus the ones read ahead
+        self.assertLessEqual(peak[0], 2 + 5)
+
+    def test_item_size(self):
+        buffered = []
+
+        def items():
+            for i in range(20):
+                buffered.append(i)
+                yield list(range(10))
+
+        def fn(batch):
+            # NOTE: a lookahead of 25 units holds 3 batches of 10
+            self.assertLessEqual(len(buffered) - len(started), 1 + 3)
+            started.append(batch)
+            time.sleep(0.001)
+
+        started = []
+        bulk.run(fn, items(), concurrency=1, lookahead=25, item_size=len)
+        self.assertEqual(20, len(started))
+
+    def test_group_stats(self):
+        def fn(item):
+            if item == 'b1':
+                raise RuntimeError()
+
+        stats = bulk.run(fn, ['a1', 'a2', 'b1'], group_key=_group)
+        self.assertEqual(2, stats['a']['calls'])
+        self.assertEqual(0, stats['a']['errors'])
+        self.assertEqual(1, stats['b']['calls'])
+        self.assertEqual(1, stats['b']['errors'])
+        self.assertEqual(0, stats['b']['skipped'])
+
+    def test_add_skipped(self):
+        stats = bulk.run(lambda item: None, ['a1'], group_key=_group)
+        bulk.add_skipped(stats, {'a': 2, 'b': 3})
+        self.assertEqual(1, stats['a']['calls'])
+        self.assertEqual(2, stats['a']['skipped'])
+        self.assertEqual(0, stats['b']['calls'])
+        self.assertEqual(3, stats['b']['skipped'])
+
+    def test_callback_error_raised(self):
+        calls = []
+
+        def callback(index, item, result, exc, latency):
+            calls.append(index)
+            raise KeyError(index)
+
+        self.assertRaises(KeyError, bulk.run, lambda item: item,
+                          range(100), concurrency=1, callback=callback)
+        # NOTE: no more items are handed out after the error
+        self.assertEqual([0], calls)
+
+    def test_group_key_error_raised(self):
+        def group_key(item):
+            raise KeyError(item)
+
+        self.assertRaises(KeyError, bulk.run, lambda item: item, range(3),
+                          group_key=group_key)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, bulk.run, lambda item: item, [],
+                          concurrency=0)
+        self.assertRaises(ValueError, bulk.run, lambda item: item, [],
+                          order='random')
+        self.assertRaises(ValueError, bulk.run, lambda item: item, [],
+                          group_concurrency={'a': 0})
+
+
+class IterBatchesTest(unittest.TestCase):
+
+    def test_batches(self):
+        self.assertEqual(
+            [(None, [(0, 'a'), (1, 'b')]), (None, [(2, 'c')])],
+            list(bulk.iter_batches(['a', 'b', 'c'], 2)))
+
+    def test_grouped_batches(self):
+        self.assertEqual(
+            [('a', [(0, 'a1'), (2, 'a2')]), ('b', [(1, 'b1')]),
+             ('a', [(3, 'a3')])],
+            list(bulk.iter_batches(['a1', 'b1', 'a2', 'a3'], 2, _group)))
@@ -0,0 +1,194 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from novaguestclient import completion
+from novaguestclient.v1 import networking
+
+KIND = completion.KIND_INSTANCE
+
+
+class _FakeHTTPClient(object):
+
+    def __init__(self, completion_cache=None):
+        self.completion_cache = completion_cache
+
+
+class _FakeNetworkingManager(object):
+
+    def __init__(self, client, infos):
+        self.client = client
+        self.infos = infos
+
+    def list(self):
+        items = [networking.Networking(self, info, loaded=True)
+                 for info in self.infos]
+        if self.client.completion_cache is not None:
+            self.client.completion_cache.add_resources(KIND, items)
+        return items
+
+
+class _FakeGuestClient(object):
+
+    def __init__(self, infos, completion_cache=None):
+        self.http_client = _FakeHTTPClient(completion_cache)
+        self.networking = _FakeNetworkingManager(self.http_client, infos)
+
+
+class CompletionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.cache = self._make_cache()
+
+    def _make_cache(self, **kwargs):
+        return completion.CompletionCache(
+            scope=('http://keystone', 'project'), path=self.base_dir,
+            **kwargs)
+
+    def _index_lines(self):
+        path = os.path.join(self.cache.path, KIND + '.idx')
+        with open(path, 'rb') as fin:
+            return fin.read().splitlines()
+
+    def test_lookup_prefix(self):
+        self.cache.add(KIND, [('abc', 'abc'), ('abd', 'abd'), ('b', 'b')])
+        self.assertEqual(['abc', 'abd'], self.cache.lookup(KIND, 'ab'))
+        self.assertEqual(['abc', 'abd', 'b'], self.cache.lookup(KIND))
+        self.assertEqual([], self.cache.lookup(KIND, 'c'))
+        self.assertEqual([], self.cache.lookup(completion.KIND_EXPORT))
+
+    def test_lookup_index_and_journal(self):
+        self.cache.add(KIND, [('id-2', 'id-2')])
+        self.cache.compact(KIND)
+        self.cache.add(KIND, [('id-1', 'id-1'), ('id-3', 'id-3')])
+        self.assertEqual(['id-1', 'id-2', 'id-3'],
+                         self.cache.lookup(KIND, 'id-'))
+        self.assertEqual(['id-1'], self.cache.lookup(KIND, 'id-', limit=1))
+
+    def test_lookup_large_index(self):
+        entries = [('%05d' % i, '%05d' % i) for i in range(5000)]
+        self.cache.add(KIND, entries)
+        # NOTE: batches this large go straight to the index
+        self.assertFalse(os.path.exists(
+            os.path.join(self.cache.path, KIND + '.journal')))
+        self.assertEqual(['%05d' % i for i in range(1230, 1240)],
+                         self.cache.lookup(KIND, '0123'))
+        self.assertEqual(['00000'], self.cache.lookup(KIND, '00000'))
+        self.assertEqual(['04999'], self.cache.lookup(KIND, '04999'))
+        self.assertEqual([], self.cache.lookup(KIND, '05'))
+
+    def test_compact_drops_duplicates(self):
+        self.cache.add(KIND, [('a', 'a'), ('b', 'b')])
+        self.cache.compact(KIND)
+        self.cache.add(KIND, [('a', 'a')])
+        self.cache.compact(KIND)
+        self.assertEqual([b'a', b'b'],
+                         [line.split(b'\t')[0]
+                          for line in self._index_lines()])
+        self.assertEqual(['a', 'b'], self.cache.lookup(KIND))
+        # NOTE: neither the journal nor temporary files are left behind
+        self.assertEqual(sorted([KIND + '.idx', KIND + '.lock']),
+                         sorted(os.listdir(self.cache.path)))
+
+    def test_concurrent_compactions(self):
+        def add(thread_index):
+            for i in range(20):
+                key = '%02d-%02d' % (thread_index, i)
+                self.cache.add(KIND, [(key, key)])
+                self.cache.compact(KIND)
+
+        threads = [threading.Thread(target=add, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(80, len(self.cache.lookup(KIND)))
+        self.assertEqual(80, len(self._index_lines()))
+
+    def test_compact_drops_expired(self):
+        self.cache.add(KIND, [('old', 'old')])
+        self.cache.compact(KIND, before=time.time() + 1)
+        self.cache.add(KIND, [('new', 'new')])
+        self.cache.compact(KIND)
+        self.assertEqual(['new'], self.cache.lookup(KIND))
+
+    def test_ttl(self):
+        cache = self._make_cache(ttl=0)
+        cache.add(KIND, [('a', 'a')])
+        time.sleep(0.01)
+        self.assertEqual([], cache.lookup(KIND))
+
+    def test_malformed_lines_ignored(self):
+        self.cache.add(KIND, [('a', 'a'), ('c', 'c')])
+        self.cache.compact(KIND)
+        journal_path = os.path.join(self.cache.path, KIND + '.journal')
+        with open(journal_path, 'ab') as fout:
+            fout.write(b'b\tb\n')
+            fout.write(b'bb\tbb\tnot-a-timestamp\n')
+            # NOTE: a truncated timestamp makes the entry expired
+            fout.write(b'bc\tbc\t12')
+        self.assertEqual(['a', 'c'], self.cache.lookup(KIND))
+        self.cache.compact(KIND)
+        self.assertEqual(['a', 'c'], self.cache.lookup(KIND))
+        self.assertEqual(2, len(self._index_lines()))
+
+    def test_separators_in_keys(self):
+        self.cache.add(KIND, [('a\tb\nc', 'id')])
+        self.assertEqual(['a b c'], self.cache.lookup(KIND, 'a'))
+
+    def test_human_ids(self):
+        client = _FakeGuestClient([
+            {'instance_id': 'uuid-1', 'name': 'My Instance'},
+            {'instance_id': 'uuid-2'},
+        ])
+        self.cache.add_resources(KIND, client.networking.list())
+        self.assertEqual(['my-instance', 'uuid-1', 'uuid-2'],
+                         self.cache.lookup(KIND))
+
+    def test_refresh(self):
+        self.cache.add(KIND, [('gone', 'gone')])
+        time.sleep(0.01)
+        client = _FakeGuestClient([{'instance_id': 'uuid-1'}])
+        self.assertEqual({KIND: 1}, self.cache.refresh(client))
+        self.assertEqual(['uuid-1'], self.cache.lookup(KIND))
+
+    def test_refresh_with_client_cache(self):
+        # NOTE: the shell gives the client its own instance for the same
+        # directory
+        client = _FakeGuestClient(
+            [{'instance_id': 'uuid-1'}], completion_cache=self._make_cache())
+        added = []
+        add_resources = self.cache.add_resources
+        self.cache.add_resources = lambda kind, resources: added.append(
+            add_resources(kind, resources))
+        self.cache.refresh(client)
+        self.assertEqual([], added)
+        self.assertEqual(['uuid-1'], self.cache.lookup(KIND))
+
+    def test_clear(self):
+        self.cache.add(KIND, [('a', 'a')])
+        self.cache.compact(KIND)
+        self.cache.add(KIND, [('b', 'b')])
+        self.cache.clear(KIND)
+        self.assertEqual([], self.cache.lookup(KIND))
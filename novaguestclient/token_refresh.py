@@ -0,0 +1,145 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Background refresh of keystone tokens before they expire.
+
+keystoneauth re-authenticates lazily, under the auth plugin's lock, once
+the token is about to expire, making all the threads using the session
+wait for the new token at the same time. The refresher fetches the new
+token beforehand, outside of that lock, and swaps it in once ready, so
+requests keep using the current token in the meantime.
+"""
+
+import logging
+import threading
+import time
+
+from novaguestclient import singleflight
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: must be larger than keystoneauth's MIN_TOKEN_LIFE_SECONDS (120s) for
+# the refresh to happen before keystoneauth's own one
+DEFAULT_REFRESH_MARGIN = 300
+_MIN_TOKEN_LIFE_SECONDS = 120
+DEFAULT_CHECK_INTERVAL = 15
+
+
+class TokenRefresher(object):
+    """ Refreshes the token of a session's auth plugin when less than
+    `margin` seconds are left before it expires.
+
+    Only plugins able to obtain a new token on their own (e.g. password
+    based ones) benefit from it: re-authenticating with a token returns one
+    expiring at the same time.
+
+    The margin must be larger than the remaining lifetime at which the
+    plugin re-authenticates on its own (MIN_TOKEN_LIFE_SECONDS, 120s by
+    default), as the refresher would otherwise never run first.
+    """
+
+    def __init__(self, session, auth=None, margin=DEFAULT_REFRESH_MARGIN,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.session = session
+        self.auth = auth or session.auth
+        min_token_life = getattr(self.auth, 'MIN_TOKEN_LIFE_SECONDS',
+                                 _MIN_TOKEN_LIFE_SECONDS)
+        if margin <= min_token_life:
+            raise ValueError(
+                "The token refresh margin must be larger than %d seconds, "
+                "got %s" % (min_token_life, margin))
+        self.margin = margin
+        self.check_interval = check_interval
+        self._singleflight = singleflight.SingleFlight()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._refreshes = 0
+        self._failures = 0
+        self._last_latency = None
+        self._total_latency = 0.0
+        self._last_refresh_at = None
+
+    def needs_refresh(self):
+        auth_ref = getattr(self.auth, 'auth_ref', None)
+        # NOTE: the first authentication happens with the first request
+        return (auth_ref is not None and
+                auth_ref.will_expire_soon(stale_duration=self.margin))
+
+    def _refresh(self):
+        start = time.time()
+        try:
+            auth_ref = self.auth.get_auth_ref(self.session)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+            raise
+        # NOTE: in-flight requests already hold the previous token, which is
+        # still valid as the refresh happens ahead of its expiration
+        self.auth.auth_ref = auth_ref
+        latency = time.time() - start
+        with self._lock:
+            self._refreshes += 1
+            self._last_latency = latency
+            self._total_latency += latency
+            self._last_refresh_at = time.time()
+        LOG.debug("Refreshed token in %.3fs, expires at %s",
+                  latency, auth_ref.expires)
+        return auth_ref
+
+    def refresh(self):
+        """ Fetches a new token, sharing the result between concurrent
+        callers instead of fetching one for each of them. """
+        return self._singleflight.do('refresh', self._refresh)
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                if self.needs_refresh():
+                    self.refresh()
+            except Exception as ex:
+                LOG.warning("Proactive token refresh failed: %s", ex)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='nova-guest-token-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def get_stats(self):
+        auth_ref = getattr(self.auth, 'auth_ref', None)
+        with self._lock:
+            stats = {
+                'refreshes': self._refreshes,
+                'failures': self._failures,
+                'last_latency': self._last_latency,
+                'mean_latency': (self._total_latency / self._refreshes
+                                 if self._refreshes else None),
+                'last_refresh_at': self._last_refresh_at,
+            }
+        # NOTE: concurrent refresh() calls served by an in-flight refresh
+        stats['coalesced'] = self._singleflight.get_stats()['coalesced']
+        stats['expires_at'] = (
+            auth_ref.expires.isoformat() if auth_ref is not None else None)
+        return stats
@@ -0,0 +1,235 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Lightweight tracing spans, exported to a pluggable exporter and propagated
+to the guest agent through request headers.
+
+Tracing is enabled per thread, so that the concurrent commands run by the
+daemon each export their spans to their own exporter. It is disabled until
+configure() is called, in which case span() returns a shared no-op span.
+Functions run from other threads on behalf of a traced one, such as the
+workers of a bulk run, must be wrapped with wrap().
+"""
+
+import functools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+TRACEPARENT_HEADER = 'traceparent'
+REQUEST_ID_HEADER = 'X-OpenStack-Request-ID'
+
+_TRACE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_INVALID_TRACE_ID = '0' * 32
+
+_local = threading.local()
+_random = random.SystemRandom()
+
+
+def _new_id(bits):
+    return '%0*x' % (bits // 4, _random.getrandbits(bits))
+
+
+def new_trace_id():
+    return _new_id(128)
+
+
+def is_valid_trace_id(trace_id):
+    """ Returns whether the given value is a valid W3C trace id: 32
+    lowercase hexadecimal characters, not all zeros. """
+    return bool(_TRACE_ID_RE.match(trace_id or '')) and (
+        trace_id != _INVALID_TRACE_ID)
+
+
+class _Tracer(object):
+    def __init__(self, exporter, default_trace_id):
+        self.exporter = exporter
+        self.default_trace_id = default_trace_id
+
+
+class FileExporter(object):
+    """ Appends each finished span as a JSON line to the given file. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as fout:
+                fout.write(line)
+
+
+class _NullSpan(object):
+    recording = False
+    trace_id = None
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def get_headers(self):
+        return {}
+
+    def finish(self, error=None):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    recording = True
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None,
+                 exporter=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._exporter = exporter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(error=exc_value)
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def get_headers(self):
+        """ Returns the headers propagating this span to the guest agent,
+        including a new request id which is also recorded on the span. """
+        request_id = 'req-%s' % uuid.uuid4()
+        self.attributes['request_id'] = request_id
+        return {
+            TRACEPARENT_HEADER: '00-%s-%s-01' % (self.trace_id, self.span_id),
+            REQUEST_ID_HEADER: request_id,
+        }
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.time() - self.start
+        if error is not None:
+            self.error = '%s: %s' % (type(error).__name__, error)
+        stack = _get_stack()
+        if self in stack:
+            stack.remove(self)
+        if self._exporter is not None:
+            self._exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def configure(exporter, trace_id=None):
+    """ Enables tracing in the calling thread.
+
+    :param exporter: object with an export(span) method called for each
+        finished span
+    :param trace_id: trace id used by the spans started without a parent,
+        e.g. to join a trace started by an orchestrator. A new trace is
+        started for each of them if not set.
+    """
+    if trace_id is not None and not is_valid_trace_id(trace_id):
+        raise ValueError("Invalid trace id '%s', expected 32 lowercase "
+                         "hexadecimal characters" % trace_id)
+    _local.tracer = _Tracer(exporter, trace_id)
+    _local.stack = []
+
+
+def disable():
+    """ Disables tracing in the calling thread. """
+    _local.tracer = None
+    _local.stack = []
+
+
+def is_enabled():
+    return getattr(_local, 'tracer', None) is not None
+
+
+def wrap(fn):
+    """ Returns `fn` wrapped to run with the tracing state of the calling
+    thread, its spans being children of the current span, whichever thread
+    runs it. Returns `fn` itself if tracing is disabled. """
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        return fn
+    stack = _get_stack()
+    parent = stack[-1] if stack else None
+
+    @functools.wraps(fn)
+    def _wrapped(*args, **kwargs):
+        previous = (getattr(_local, 'tracer', None),
+                    getattr(_local, 'stack', None))
+        _local.tracer = tracer
+        _local.stack = [parent] if parent is not None else []
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.tracer, _local.stack = previous
+    return _wrapped
+
+
+def span(name, **attributes):
+    """ Starts a span, child of the current span of this thread, which is
+    finished when exiting it as a context manager or by calling finish().
+    """
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        return _NULL_SPAN
+    stack = _get_stack()
+    if stack:
+        parent = stack[-1]
+        new_span = Span(name, parent.trace_id, parent.span_id, attributes,
+                        tracer.exporter)
+    else:
+        new_span = Span(name, tracer.default_trace_id or new_trace_id(),
+                        attributes=attributes, exporter=tracer.exporter)
+    stack.append(new_span)
+    return new_span
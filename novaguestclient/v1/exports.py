@@ -0,0 +1,282 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from novaguestclient import base
+from novaguestclient import bulk
+from novaguestclient import completion
+from novaguestclient import exceptions
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+_READ_BUFFER_SIZE = 1024 * 1024
+_STATE_SUFFIX = '.part'
+
+
+class Export(base.Resource):
+    HUMAN_ID = True
+
+
+_seek_lock = threading.Lock()
+
+
+def _write_at(fd, data, offset):
+    """ Writes all of `data` at the given file offset. """
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            # NOTE: os.pwrite is not available on Python 2
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+class _DownloadState(object):
+    """ Resume information of a download, persisted next to the target
+    file as the chunks complete. """
+
+    def __init__(self, path, export_id, size, etag, chunk_size):
+        self.path = path
+        self.info = {
+            'export_id': export_id,
+            'size': size,
+            'etag': etag,
+            'chunk_size': chunk_size,
+            'chunks': {},
+        }
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Loads the completed chunks of a previous attempt, if it was for
+        the same export data. """
+        try:
+            with open(self.path) as fin:
+                previous = json.load(fin)
+        except (IOError, OSError, ValueError):
+            return
+        keys = ('export_id', 'size', 'etag', 'chunk_size')
+        if all(previous.get(k) == self.info[k] for k in keys):
+            self.info['chunks'] = previous.get('chunks', {})
+
+    def get_completed(self):
+        with self._lock:
+            return dict((int(index), checksum) for (index, checksum)
+                        in self.info['chunks'].items())
+
+    def complete(self, index, checksum):
+        with self._lock:
+            self.info['chunks'][str(index)] = checksum
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fout:
+                json.dump(self.info, fout)
+            os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ExportManager(base.BaseManager):
+    resource_class = Export
+    completion_kind = completion.KIND_EXPORT
+
+    def __init__(self, api):
+        super(ExportManager, self).__init__(api)
+
+    def get(self, export_id):
+        return self._get('/exports/%s' % base.getid(export_id),
+                         response_key='export')
+
+    def _download_chunk(self, url, fd, index, offset, length, use_range,
+                        checksums, checksum_size, buffers):
+        """ Streams one chunk straight to its offset in the target file,
+        returning its SHA-256 checksum.
+
+        The data is verified against the export's checksums, each covering
+        `checksum_size` bytes, at their own boundaries: a chunk downloaded
+        without range requests covers all of them.
+        """
+        buf = getattr(buffers, 'buf', None)
+        if buf is None:
+            buf = buffers.buf = memoryview(bytearray(_READ_BUFFER_SIZE))
+
+        # NOTE: the raw stream is written as is, so it must not be compressed
+        headers = {'Accept-Encoding': 'identity'}
+        if use_range:
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        resp = self.client.get(url, headers=headers, stream=True, log=False)
+        try:
+            if use_range and resp.status_code != 206:
+                raise exceptions.ExportDownloadError(
+                    "Expected a partial response for chunk %d, got HTTP %d" %
+                    (index, resp.status_code))
+            checksum = hashlib.sha256()
+            position = offset
+            end = offset + length
+            while position < end:
+                segment_index = segment_checksum = None
+                segment_end = end
+                if checksum_size:
+                    segment_index = position // checksum_size
+                    segment_end = min(
+                        (segment_index + 1) * checksum_size, end)
+                    if segment_index < len(checksums):
+                        segment_checksum = hashlib.sha256()
+
+                while position < segment_end:
+                    read = resp.raw.readinto(
+                        buf[:min(segment_end - position, len(buf))])
+                    if not read:
+                        raise exceptions.ExportDownloadError(
+                            "Chunk %d ended %d bytes early" % (
+                                index, end - position))
+                    checksum.update(buf[:read])
+                    if segment_checksum is not None:
+                        segment_checksum.update(buf[:read])
+                    _write_at(fd, buf[:read], position)
+                    position += read
+
+                if segment_checksum is not None:
+                    expected = checksums[segment_index]
+                    actual = segment_checksum.hexdigest()
+                    if actual != expected:
+                        raise exceptions.ChecksumMismatch(
+                            segment_index, expected, actual)
+        finally:
+            resp.close()
+        return checksum.hexdigest()
+
+    def download(self, export_id, path, chunk_size=None, concurrency=4,
+                 resume=True, retries=3, progress_callback=None):
+        """ Downloads the data of an export to `path` with parallel HTTP
+        Range requests, writing each chunk directly at its offset in the
+        preallocated file.
+
+        The completed chunks are recorded in a '<path>.part' file, so that
+        an interrupted download can be resumed. The chunks are checked
+        against the per-chunk SHA-256 checksums listed by the export, if
+        any.
+
+        :param chunk_size: bytes per request, unless the export lists its
+            own chunk size along with their checksums
+        :param retries: attempts per chunk after the first one failed
+        :param progress_callback: called as progress_callback(done, total)
+            in bytes after each chunk
+        :returns: dict describing the transfer
+        """
+        export_id = base.getid(export_id)
+        info = self.get(export_id)
+        checksums = getattr(info, 'chunk_checksums', None) or []
+        checksum_size = None
+        if checksums:
+            chunk_size = checksum_size = info.chunk_size
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+
+        url = '/exports/%s/data' % export_id
+        head = self.client.head(url)
+        size = int(head.headers['Content-Length'])
+        use_range = head.headers.get('Accept-Ranges') == 'bytes'
+        if not use_range:
+            chunk_size = max(size, 1)
+        chunk_count = (size + chunk_size - 1) // chunk_size
+
+        state = _DownloadState(path + _STATE_SUFFIX, export_id, size,
+                               head.headers.get('ETag'), chunk_size)
+        if resume and os.path.exists(path):
+            state.load()
+        completed = state.get_completed()
+        pending = [index for index in range(chunk_count)
+                   if index not in completed]
+
+        def _get_length(index):
+            return min(chunk_size, size - index * chunk_size)
+
+        resumed_bytes = sum(_get_length(index) for index in completed)
+        progress = {'done': resumed_bytes}
+        progress_lock = threading.Lock()
+        failed = {}
+        stats = {'retries': 0}
+        buffers = threading.local()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+                if hasattr(os, 'posix_fallocate') and size:
+                    os.posix_fallocate(fd, 0, size)
+
+            def _download(index):
+                for attempt in range(retries + 1):
+                    try:
+                        return self._download_chunk(
+                            url, fd, index, index * chunk_size,
+                            _get_length(index), use_range, checksums,
+                            checksum_size, buffers)
+                    except Exception:
+                        if attempt == retries:
+                            raise
+                        with progress_lock:
+                            stats['retries'] += 1
+
+            def _callback(_, index, digest, exc, latency):
+                if exc is not None:
+                    failed[index] = exc
+                    return
+                state.complete(index, digest)
+                with progress_lock:
+                    progress['done'] += _get_length(index)
+                    done = progress['done']
+                if progress_callback is not None:
+                    progress_callback(done, size)
+
+            start = time.time()
+            bulk.run(_download, pending, concurrency=concurrency,
+                     callback=_callback)
+            elapsed = time.time() - start
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if failed:
+            index, exc = sorted(failed.items())[0]
+            raise exceptions.ExportDownloadError(
+                "%d chunk(s) failed, the download can be resumed. "
+                "First error (chunk %d): %s" % (len(failed), index, exc))
+        state.remove()
+
+        downloaded = size - resumed_bytes
+        return {
+            'export_id': export_id,
+            'path': path,
+            'size': size,
+            'chunks': chunk_count,
+            'chunk_size': chunk_size,
+            'resumed_bytes': resumed_bytes,
+            'downloaded_bytes': downloaded,
+            'retries': stats['retries'],
+            'verified_chunks': min(
+                len(checksums),
+                (size + checksum_size - 1) // checksum_size
+                if checksum_size else 0),
+            'elapsed': elapsed,
+            'throughput': downloaded / elapsed if elapsed else None,
+        }
@@ -0,0 +1,201 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+
+from keystoneauth1.exceptions import http as ks_http_exceptions
+
+from novaguestclient import base
+from novaguestclient import bulk
+from novaguestclient import completion
+from novaguestclient import exceptions
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class Import(base.Resource):
+    HUMAN_ID = True
+
+
+class _ChunkReader(object):
+    """ File-like view of a chunk of a memory mapped file, hashing the data
+    as the HTTP library reads it block by block.
+
+    The reader can be rewound, e.g. by requests when following a redirect,
+    the checksum then covering the data from the start of the chunk to the
+    new position. Uploads are not resent by keystoneauth after
+    re-authenticating, see ImportManager._upload_chunk().
+    """
+
+    def __init__(self, mapped, offset, length):
+        self._mapped = mapped
+        self._start = offset
+        self._pos = offset
+        self._end = offset + length
+        self.checksum = hashlib.sha256()
+
+    def __len__(self):
+        # NOTE: used by requests for the Content-Length header, minus tell()
+        return self._end - self._start
+
+    def tell(self):
+        return self._pos - self._start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        position = self._start + min(max(offset, 0), len(self))
+        if position < self._pos:
+            self.checksum = hashlib.sha256(
+                self._mapped[self._start:position])
+        else:
+            self.checksum.update(self._mapped[self._pos:position])
+        self._pos = position
+        return self.tell()
+
+    def read(self, size=-1):
+        end = self._end
+        if size is not None and size >= 0:
+            end = min(self._pos + size, end)
+        data = self._mapped[self._pos:end]
+        self._pos = end
+        self.checksum.update(data)
+        return data
+
+
+class ImportManager(base.BaseManager):
+    resource_class = Import
+    completion_kind = completion.KIND_IMPORT
+
+    def __init__(self, api):
+        super(ImportManager, self).__init__(api)
+
+    def get(self, import_id):
+        return self._get('/imports/%s' % base.getid(import_id),
+                         response_key='import')
+
+    def _upload_chunk(self, import_id, mapped, index, offset, length):
+        # NOTE: keystoneauth would send the same, already read, body again
+        # after re-authenticating, so a new reader is used instead
+        reauthenticated = False
+        while True:
+            reader = _ChunkReader(mapped, offset, length)
+            try:
+                self.client.put(
+                    '/imports/%s/chunks/%d' % (import_id, index), data=reader,
+                    headers={'Content-Type': 'application/octet-stream'},
+                    log=False, allow_reauth=False)
+            except ks_http_exceptions.Unauthorized:
+                if reauthenticated or not self.client.invalidate():
+                    raise
+                reauthenticated = True
+                continue
+            return reader.checksum.hexdigest()
+
+    def upload(self, import_id, path, chunk_size=DEFAULT_CHUNK_SIZE,
+               concurrency=4, retries=3, progress_callback=None):
+        """ Uploads the image at `path` for an import task in chunks, read
+        from a memory mapping of the file so that memory use does not grow
+        with the image size.
+
+        The chunks are uploaded in parallel and those which failed are
+        retried, up to `retries` times each, before completing the upload
+        with the checksums of all the chunks.
+
+        :param chunk_size: bytes per chunk, greater than zero
+        :param progress_callback: called as progress_callback(done, total)
+            in bytes after each chunk
+        :returns: dict describing the transfer
+        :raises: ValueError if `chunk_size` is not greater than zero
+        """
+        if chunk_size < 1:
+            raise ValueError(
+                "The chunk size must be greater than zero, got %s" %
+                chunk_size)
+        import_id = base.getid(import_id)
+        size = os.path.getsize(path)
+        chunk_count = (size + chunk_size - 1) // chunk_size
+
+        def _get_length(index):
+            return min(chunk_size, size - index * chunk_size)
+
+        checksums = [None] * chunk_count
+        failed = {}
+        progress = {'done': 0}
+        progress_lock = threading.Lock()
+        pending = list(range(chunk_count))
+        attempts = 0
+
+        start = time.time()
+        with open(path, 'rb') as fin:
+            # NOTE: empty files can not be mapped
+            mapped = (mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+                      if size else None)
+            try:
+                def _upload(index):
+                    return self._upload_chunk(
+                        import_id, mapped, index, index * chunk_size,
+                        _get_length(index))
+
+                def _callback(_, index, checksum, exc, latency):
+                    if exc is not None:
+                        failed[index] = exc
+                        return
+                    checksums[index] = checksum
+                    with progress_lock:
+                        progress['done'] += _get_length(index)
+                        done = progress['done']
+                    if progress_callback is not None:
+                        progress_callback(done, size)
+
+                while pending and attempts <= retries:
+                    failed.clear()
+                    bulk.run(_upload, pending, concurrency=concurrency,
+                             callback=_callback)
+                    pending = sorted(failed)
+                    attempts += 1
+            finally:
+                if mapped is not None:
+                    mapped.close()
+
+        if pending:
+            index = pending[0]
+            raise exceptions.ImportUploadError(
+                "%d chunk(s) failed after %d attempt(s). First error (chunk "
+                "%d): %s" % (len(pending), attempts, index, failed[index]))
+
+        self.client.post(
+            '/imports/%s/actions' % import_id,
+            json={'complete-upload': {'size': size,
+                                      'chunk_size': chunk_size,
+                                      'chunk_checksums': checksums}})
+        elapsed = time.time() - start
+
+        return {
+            'import_id': import_id,
+            'path': path,
+            'size': size,
+            'chunks': chunk_count,
+            'chunk_size': chunk_size,
+            'attempts': attempts,
+            'elapsed': elapsed,
+            'throughput': size / elapsed if elapsed else None,
+        }
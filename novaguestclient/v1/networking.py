@@ -13,23 +13,350 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import hashlib
+import itertools
+import json
+import threading
+import uuid
+
+import six
+from six.moves.urllib import parse
+
 from novaguestclient import base
+from novaguestclient import bulk
+from novaguestclient import completion
+from novaguestclient import constants
 from novaguestclient import exceptions
 
+# Kind of the actions recorded in the ledger, see mirror.Mirror
+LEDGER_KIND = 'apply-networking'
+
+SKIPPED_MESSAGE = 'Networking configuration unchanged, skipped'
+
+# Number of instances looked up at once in the ledger by bulk runs
+_LEDGER_BLOCK_SIZE = 500
+
+
+def get_fingerprint(config):
+    """ Returns the fingerprint of a networking configuration: strings are
+    used as is, other values are hashed as canonical JSON. """
+    if config is None or isinstance(config, six.string_types):
+        return config
+    data = json.dumps(config, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _new_idempotency_key():
+    return str(uuid.uuid4())
+
+
+def _retry(fn, retries):
+    """ Calls `fn`, calling it again up to `retries` times if it raises. """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception:
+            if attempt == retries:
+                raise
+
 
 class Networking(base.Resource):
-    pass
+    HUMAN_ID = True
 
 
 class NetworkingManager(base.BaseManager):
     resource_class = Networking
+    completion_kind = completion.KIND_INSTANCE
 
-    def __init__(self, api):
+    def __init__(self, api, ledger=None):
         super(NetworkingManager, self).__init__(api)
+        self.ledger = ledger
 
-    def apply_networking(self, instance_id):
+    def _get_region(self):
+        return getattr(self.client, 'region_name', None) or ''
+
+    def list(self, updated_since=None, timeout=None):
+        """ Lists the networking results reported by the guest agent.
+
+        :param updated_since: ISO 8601 time; only the results updated at or
+            after it are returned
+        """
+        url = '/networking'
+        if updated_since:
+            url += '?%s' % parse.urlencode({'updated_since': updated_since})
+        return self._list(url, response_key='networking', timeout=timeout)
+
+    def _apply_networking(self, instance_id, idempotency_key):
         data = self.client.post(
             '/networking/%s/actions' % instance_id,
-            json={'apply-networking': None}).json()
+            json={'apply-networking': None},
+            headers={constants.IDEMPOTENCY_KEY_HEADER: idempotency_key},
+            idempotent=True).json()
         validate_data = data["apply-networking"]
         return validate_data.get("success"), validate_data.get("message")
+
+    def apply_networking(self, instance_id, fingerprint=None,
+                         idempotency_key=None):
+        """ Applies networking on an instance. The request carries an
+        idempotency key, letting the guest agent recognize its retries.
+
+        :param fingerprint: fingerprint of the networking configuration
+            applied, see get_fingerprint(), recorded in the ledger on
+            success
+        :param idempotency_key: key to send, the one of the original call
+            when retrying it, a new one is used if None
+        """
+        idempotency_key = idempotency_key or _new_idempotency_key()
+        success, message = self._apply_networking(
+            instance_id, idempotency_key)
+        if success and self.ledger is not None:
+            self.ledger.record_applied(
+                LEDGER_KIND, instance_id, get_fingerprint(fingerprint),
+                idempotency_key, self._get_region())
+        return success, message
+
+    def supports_batch(self):
+        return self.client.supports(constants.API_CAPABILITY_BATCH_ACTIONS)
+
+    def _apply_networking_batch(self, instance_ids, idempotency_key):
+        instance_ids = list(instance_ids)
+        data = self.client.post(
+            '/networking/actions',
+            json={'apply-networking': {'instance_ids': instance_ids}},
+            headers={constants.IDEMPOTENCY_KEY_HEADER: idempotency_key},
+            idempotent=True).json()
+        batch_data = data["apply-networking"]
+
+        results = {}
+        for instance_id in instance_ids:
+            validate_data = batch_data.get(instance_id)
+            if validate_data is None:
+                results[instance_id] = (
+                    False, "No result returned for instance %s" % instance_id)
+            else:
+                results[instance_id] = (validate_data.get("success"),
+                                        validate_data.get("message"))
+        return results
+
+    def apply_networking_batch(self, instance_ids, fingerprints=None,
+                               idempotency_key=None):
+        """ Applies networking on several instances with a single request.
+        Requires a guest agent advertising batch actions support.
+
+        :param fingerprints: dict with the fingerprint of the configuration
+            applied on each instance, recorded in the ledger on success
+        :param idempotency_key: key to send, the one of the original call
+            when retrying it, a new one is used if None
+        :returns: dict mapping each instance id to its (success, message)
+        """
+        idempotency_key = idempotency_key or _new_idempotency_key()
+        results = self._apply_networking_batch(instance_ids, idempotency_key)
+        if self.ledger is not None:
+            fingerprints = fingerprints or {}
+            self.ledger.record_applied_many(
+                LEDGER_KIND,
+                [(instance_id, get_fingerprint(fingerprints.get(instance_id)),
+                  idempotency_key)
+                 for (instance_id, (success, _)) in results.items()
+                 if success],
+                self._get_region())
+        return results
+
+    def apply_networking_bulk(self, instance_ids, concurrency=10,
+                              aggregate=False, size=None, batch_size=100,
+                              group_by=None, group_concurrency=None,
+                              order=bulk.ORDER_FIFO,
+                              expected_durations=None, fingerprints=None,
+                              skip_unchanged=True, retries=0):
+        """ Applies networking on many instances concurrently.
+
+        If the guest agent supports batch actions, the instances are sent
+        in batches of `batch_size` per request, otherwise one request is
+        sent per instance. The results are the same in both cases.
+
+        :param instance_ids: iterable of instance ids, consumed lazily
+        :param aggregate: if True, return a bulk.OutcomeAggregator holding
+            compact outcomes addressed by the position of each instance in
+            `instance_ids`, instead of a dict mapping each instance id to
+            its (success, message) tuple
+        :param size: number of instances, if known and `instance_ids` has
+            no length, used to preallocate the aggregated outcomes
+        :param batch_size: maximum number of instances per batch request,
+            or None to never use batch requests
+        :param group_by: dict mapping instance ids to a group, such as
+            their OS type (constants.OS_TYPE_*), or callable returning the
+            group of an instance id. Each group gets its own queue and
+            concurrency limit, see bulk.run(). Instances missing from the
+            dict are in the constants.OS_TYPE_UNKNOWN group.
+        :param group_concurrency: dict with the maximum number of
+            concurrent requests per group
+        :param order: the bulk.ORDER_* policy choosing the group to run next
+        :param expected_durations: dict with the initial expected request
+            duration per group in seconds
+        :param fingerprints: dict mapping instance ids to their networking
+            configuration or its fingerprint, see get_fingerprint()
+        :param skip_unchanged: if a ledger is set, skip the instances whose
+            fingerprint matches the one of their last successful apply.
+            Skipped instances have the bulk.OUTCOME_SKIPPED outcome when
+            aggregating, or a successful SKIPPED_MESSAGE result otherwise,
+            and are counted in the `skipped` field of their group's stats.
+        :param retries: number of times a request which raised is sent
+            again, with the same idempotency key
+        :returns: bulk.OutcomeAggregator when aggregating, otherwise a
+            bulk.BulkResults dict, both holding the per-group stats in
+            their `group_stats` attribute
+        """
+        if size is None and hasattr(instance_ids, '__len__'):
+            size = len(instance_ids)
+        fingerprints = dict(
+            (instance_id, get_fingerprint(config))
+            for (instance_id, config) in six.iteritems(fingerprints or {}))
+        region = self._get_region()
+
+        group_key = group_by
+        if isinstance(group_by, dict):
+            def group_key(instance_id):
+                return group_by.get(instance_id, constants.OS_TYPE_UNKNOWN)
+        scheduling_kwargs = {
+            'concurrency': concurrency,
+            'group_concurrency': group_concurrency,
+            'order': order,
+            'expected_durations': expected_durations,
+        }
+
+        if aggregate:
+            outcomes = bulk.OutcomeAggregator(size=size or 0)
+
+            def _record(index, instance_id, result, exc, latency):
+                if exc is not None:
+                    outcomes.record_exception(index, exc, latency)
+                else:
+                    outcomes.record_result(index, result[0], result[1],
+                                           latency)
+
+            def _skip(index, instance_id):
+                outcomes.record_skipped(index)
+        else:
+            results = bulk.BulkResults()
+            lock = threading.Lock()
+
+            def _record(index, instance_id, result, exc, latency):
+                if exc is not None:
+                    result = (False, str(exc))
+                with lock:
+                    results[instance_id] = result
+
+            def _skip(index, instance_id):
+                with lock:
+                    results[instance_id] = (True, SKIPPED_MESSAGE)
+                    results.skipped += 1
+
+        # NOTE: successful applies are written to the ledger in blocks, as
+        # a transaction per instance would slow down large runs
+        applied = []
+        applied_lock = threading.Lock()
+
+        def _flush_applied(min_count=0):
+            with applied_lock:
+                if len(applied) < max(min_count, 1):
+                    return
+                rows = list(applied)
+                del applied[:]
+            self.ledger.record_applied_many(LEDGER_KIND, rows, region)
+
+        def _callback(index, instance_id, result, exc, latency, key):
+            _record(index, instance_id, result, exc, latency)
+            if self.ledger is not None and exc is None and result[0]:
+                with applied_lock:
+                    applied.append(
+                        (instance_id, fingerprints.get(instance_id), key))
+                _flush_applied(_LEDGER_BLOCK_SIZE)
+
+        # NOTE: only updated by _iter_pending(), which the scheduler reads
+        # from one thread at a time
+        skipped_by_group = collections.Counter()
+
+        def _iter_pending():
+            """ Yields the (index, instance id) of the instances to apply
+            networking on, skipping the unchanged ones. """
+            indexed_ids = enumerate(instance_ids)
+            check = (skip_unchanged and self.ledger is not None and
+                     fingerprints)
+            while True:
+                block = list(itertools.islice(indexed_ids,
+                                              _LEDGER_BLOCK_SIZE))
+                if not block:
+                    return
+                applied_fingerprints = {}
+                if check:
+                    applied_fingerprints = (
+                        self.ledger.get_applied_fingerprints(
+                            LEDGER_KIND,
+                            [instance_id for (_, instance_id) in block],
+                            region))
+                for index, instance_id in block:
+                    fingerprint = fingerprints.get(instance_id)
+                    if (fingerprint is not None and fingerprint ==
+                            applied_fingerprints.get(instance_id)):
+                        _skip(index, instance_id)
+                        skipped_by_group[group_key(instance_id)
+                                         if group_key else None] += 1
+                    else:
+                        yield index, instance_id
+
+        item_group_key = None
+        if group_key is not None:
+            def item_group_key(item):
+                return group_key(item[1])
+
+        if batch_size and self.supports_batch():
+            def _apply_batch(batch):
+                key = _new_idempotency_key()
+                instance_ids = [
+                    instance_id for (_, (_, instance_id)) in batch[1]]
+                return key, _retry(
+                    lambda: self._apply_networking_batch(instance_ids, key),
+                    retries)
+
+            def _batch_callback(batch_index, batch, result, exc, latency):
+                key, batch_results = result if exc is None else (None, None)
+                for _, (index, instance_id) in batch[1]:
+                    _callback(index, instance_id,
+                              batch_results[instance_id]
+                              if exc is None else None,
+                              exc, latency, key)
+
+            group_stats = bulk.run(
+                _apply_batch,
+                bulk.iter_batches(_iter_pending(), batch_size,
+                                  item_group_key),
+                callback=_batch_callback,
+                group_key=lambda batch: batch[0] if group_key else None,
+                # NOTE: the lookahead bounds the buffered instances, not
+                # batches
+                item_size=lambda batch: len(batch[1]),
+                **scheduling_kwargs)
+        else:
+            def _apply(item):
+                key = _new_idempotency_key()
+                return key, _retry(
+                    lambda: self._apply_networking(item[1], key), retries)
+
+            def _item_callback(run_index, item, result, exc, latency):
+                key, result = result if exc is None else (None, None)
+                _callback(item[0], item[1], result, exc, latency, key)
+
+            group_stats = bulk.run(
+                _apply, _iter_pending(), callback=_item_callback,
+                group_key=item_group_key, **scheduling_kwargs)
+
+        if self.ledger is not None:
+            _flush_applied()
+
+        bulk.add_skipped(group_stats, skipped_by_group)
+        if aggregate:
+            outcomes.group_stats = group_stats
+            return outcomes
+        results.group_stats = group_stats
+        return results
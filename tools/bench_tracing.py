@@ -0,0 +1,88 @@
+# Copyright (c) 2018 Cloudbase Solutions Srl
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures the per-request overhead of the tracing spans and profiling phase
+markers wrapping each _HTTPClient request, with tracing disabled and with
+tracing enabled and an exporter discarding the spans.
+
+Requests go through the real Client, _HTTPClient and keystoneauth session,
+down to a requests transport answering with a canned response instead of
+the network, so that the difference between both runs is the tracing
+overhead rather than noise.
+
+Usage: python tools/bench_tracing.py [iterations]
+"""
+
+import json
+import sys
+import timeit
+
+from keystoneauth1 import session
+import requests
+
+from novaguestclient import client
+from novaguestclient import tracing
+
+_BODY = json.dumps({'networking': []}).encode('utf-8')
+
+
+class _NullExporter(object):
+    def export(self, span):
+        pass
+
+
+class _CannedTransport(requests.Session):
+    """ requests session answering every request with an empty networking
+    list, without any I/O. """
+
+    def request(self, method, url, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers['Content-Type'] = 'application/json'
+        resp._content = _BODY
+        resp.url = url
+        resp.request = requests.Request(method, url).prepare()
+        return resp
+
+
+def _measure(http_client, iterations):
+    def _request():
+        http_client.get('/networking')
+
+    seconds = min(timeit.repeat(_request, number=iterations, repeat=3))
+    return seconds / iterations * 1e6
+
+
+def main(argv=sys.argv[1:]):
+    iterations = int(argv[0]) if argv else 100000
+    http_client = client.Client(
+        session=session.Session(session=_CannedTransport()),
+        endpoint='http://guest-agent.invalid').http_client
+
+    tracing.disable()
+    disabled = _measure(http_client, iterations)
+    tracing.configure(_NullExporter())
+    try:
+        enabled = _measure(http_client, iterations)
+    finally:
+        tracing.disable()
+
+    print('tracing disabled: %.2f us per request' % disabled)
+    print('tracing enabled:  %.2f us per request' % enabled)
+    print('overhead:         %.2f us per request' % (enabled - disabled))
+
+
+if __name__ == '__main__':
+    main()